@@ -0,0 +1,70 @@
+#!/usr/bin/python
+r"""Compare the AggregateOutputs backends on an I/O-bound stack (calls that
+sleep) and a CPU-bound one (large factorials)
+
+Run from the repository root:
+    python benchmarks/bench_aggregate_backends.py -n 32 -p 4
+"""
+from optparse import OptionParser
+import os
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+from process_tools import aggregate_outputs
+
+
+def time_backend(backend, funcname, arg, n_calls, n_worker):
+    r"""return the wall time to run `n_calls` calls of funcname(arg)"""
+    aggregate = aggregate_outputs.AggregateOutputs(funcname)
+    for index in range(n_calls):
+        aggregate.execute(arg, execute_key="%d" % index)
+
+    start = time.time()
+    # the results are not needed, only the time to produce them
+    for (execute_key, result) in aggregate.imap_stack(ncpu=n_worker,
+                                                      backend=backend):
+        pass
+
+    return time.time() - start
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage="usage: %prog [options]")
+    parser.add_option("-n", "--n_calls", action="store", type="int",
+                      dest="n_calls", default=32,
+                      help="Number of calls in each stack",)
+    parser.add_option("-p", "--n_worker", action="store", type="int",
+                      dest="n_worker", default=4,
+                      help="Number of worker processes or threads",)
+    parser.add_option("-s", "--sleep", action="store", type="float",
+                      dest="sleep", default=0.05,
+                      help="Seconds each I/O-bound call waits",)
+    parser.add_option("-f", "--factorial", action="store", type="int",
+                      dest="factorial", default=20000,
+                      help="Argument of each CPU-bound factorial call",)
+
+    (options, args) = parser.parse_args()
+
+    backends = aggregate_outputs.BACKENDS
+
+    workloads = [("I/O-bound", "time.sleep", options.sleep),
+                 ("CPU-bound", "math.factorial", options.factorial)]
+
+    timings = {}
+    # each call is reported on stdout
+    sys.stdout = open(os.devnull, "w")
+    try:
+        for (label, funcname, arg) in workloads:
+            for backend in backends:
+                timings[(label, backend)] = time_backend(
+                        backend, funcname, arg, options.n_calls,
+                        options.n_worker)
+    finally:
+        sys.stdout = sys.__stdout__
+
+    print "%d calls, %d workers" % (options.n_calls, options.n_worker)
+    for (label, funcname, arg) in workloads:
+        for backend in backends:
+            print "%s %-8s %10.3f s" % (label, backend,
+                                        timings[(label, backend)])
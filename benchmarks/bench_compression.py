@@ -0,0 +1,91 @@
+#!/usr/bin/python
+r"""Benchmark bytes on disk and read throughput of the cache_store codecs
+
+For each representative NumPy payload and codec, write `n_records` results
+to a ShelveStore and read them back.
+
+Run from the repository root:
+    python benchmarks/bench_compression.py -n 5
+"""
+from optparse import OptionParser
+import os
+import sys
+import time
+import shutil
+import tempfile
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+from process_tools import cache_store
+
+
+def payloads(size):
+    r"""dict of name: result trees typical of cached map-making outputs"""
+    random_state = np.random.RandomState(0)
+
+    sparse = np.zeros((size, size))
+    hits = random_state.randint(0, size, size=(2, size * size // 100))
+    sparse[hits[0], hits[1]] = random_state.normal(size=hits.shape[1])
+
+    repeated = np.tile(random_state.normal(size=(1, size)), (size, 1))
+
+    noise = random_state.normal(size=(size, size))
+
+    return {"sparse map": {"map": sparse, "weight": (sparse != 0) * 1.},
+            "repeated rows": {"map": repeated},
+            "white noise": {"map": noise}}
+
+
+def run_codec(payload, codec, n_records):
+    r"""return (bytes on disk, seconds to write, seconds to read)"""
+    directory = tempfile.mkdtemp(prefix="bench_codec_")
+    store = cache_store.ShelveStore(directory, codec=codec)
+    identifiers = ["%056x" % index for index in range(n_records)]
+    try:
+        start = time.time()
+        for identifier in identifiers:
+            store.save(identifier, {"funcname": "bench", "args": (),
+                                    "kwargs": {}, "result": payload}, 0.)
+
+        write_time = time.time() - start
+
+        start = time.time()
+        for identifier in identifiers:
+            store.load(identifier)
+
+        read_time = time.time() - start
+
+        nbytes = sum(entry[1] for entry in store.entries())
+    finally:
+        shutil.rmtree(directory)
+
+    return (nbytes, write_time, read_time)
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage="usage: %prog [options]")
+    parser.add_option("-n", "--n_records", action="store", type="int",
+                      dest="n_records", default=5,
+                      help="Number of records per payload and codec",)
+    parser.add_option("-s", "--size", action="store", type="int",
+                      dest="size", default=512,
+                      help="Maps are size x size float64",)
+
+    (options, args) = parser.parse_args()
+
+    codecs = [None] + sorted(cache_store.CODECS)
+    print "%-14s %-6s %12s %8s %12s %12s" % ("payload", "codec",
+                                             "bytes/rec", "ratio",
+                                             "write MB/s", "read MB/s")
+    for (name, payload) in sorted(payloads(options.size).items()):
+        raw_bytes = sum(array.nbytes for array in payload.values())
+        raw_total = raw_bytes * options.n_records / 1.e6
+        for codec in codecs:
+            (nbytes, write_time, read_time) = run_codec(payload, codec,
+                                                        options.n_records)
+
+            per_record = nbytes / options.n_records
+            print "%-14s %-6s %12d %8.2f %12.1f %12.1f" % \
+                  (name, codec, per_record,
+                   float(raw_bytes) / per_record,
+                   raw_total / write_time, raw_total / read_time)
@@ -0,0 +1,66 @@
+#!/usr/bin/python
+r"""Benchmark the cache-hit latency of persistent_memoize.memoize_persistent
+
+Run from the repository root:
+    python benchmarks/bench_persistent_memoize.py -n 20
+
+To compare against another revision, put its checkout first on the path:
+    PYTHONPATH=/path/to/other/checkout python benchmarks/bench_persistent_memoize.py
+"""
+from optparse import OptionParser
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+from process_tools import persistent_memoize as pm
+
+
+def cached_function(input_var, arg1="a"):
+    r"""trivial function so that only the cache overhead is measured"""
+    return (input_var, arg1)
+
+
+def time_hits(n_calls, l1_maxsize=None):
+    r"""return the mean seconds per call for `n_calls` cache hits"""
+    if l1_maxsize:
+        memoized_function = pm.memoize_persistent(
+                                cached_function, l1_maxsize=l1_maxsize)
+    else:
+        memoized_function = pm.memoize_persistent(cached_function)
+    # populate the cache
+    memoized_function(10, arg1="b")
+
+    start = time.time()
+    for index in range(n_calls):
+        memoized_function(10, arg1="b")
+
+    return (time.time() - start) / float(n_calls)
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage="usage: %prog [options]")
+    parser.add_option("-n", "--n_calls", action="store", type="int",
+                      dest="n_calls", default=20,
+                      help="Number of cache hits to time",)
+    parser.add_option("-l", "--l1_maxsize", action="store", type="int",
+                      dest="l1_maxsize", default=None,
+                      help="Size of the in-process L1 cache (default none)",)
+
+    (options, args) = parser.parse_args()
+
+    cache_directory = tempfile.mkdtemp(prefix="bench_memoize_")
+    pm.memoize_directory = cache_directory
+    # the decorator reports each call on stdout
+    sys.stdout = open(os.devnull, "w")
+    try:
+        per_call = time_hits(options.n_calls, options.l1_maxsize)
+    finally:
+        sys.stdout = sys.__stdout__
+        shutil.rmtree(cache_directory)
+
+    print "%s" % pm.__file__
+    print "cache hit latency: %10.6f ms/call over %d calls" % \
+          (per_call * 1000., options.n_calls)
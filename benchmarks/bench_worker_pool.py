@@ -0,0 +1,61 @@
+#!/usr/bin/python
+r"""Benchmark dispatching many small AggregateOutputs batches with a new pool
+per batch against a shared worker_pool.WorkerPool
+
+Run from the repository root:
+    python benchmarks/bench_worker_pool.py -b 20 -s 4 -p 4
+"""
+from optparse import OptionParser
+import os
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+from process_tools import aggregate_outputs
+from process_tools import worker_pool
+
+
+def time_batches(n_batches, batch_size, n_worker, pool=None):
+    r"""return the mean seconds per batch of trivial calls"""
+    start = time.time()
+    for batch_index in range(n_batches):
+        aggregate = aggregate_outputs.AggregateOutputs("operator.add")
+        for index in range(batch_size):
+            aggregate.execute(batch_index, index,
+                              execute_key="%d/%d" % (batch_index, index))
+
+        aggregate.multiprocess_stack(ncpu=n_worker, pool=pool)
+
+    return (time.time() - start) / float(n_batches)
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage="usage: %prog [options]")
+    parser.add_option("-b", "--n_batches", action="store", type="int",
+                      dest="n_batches", default=20,
+                      help="Number of batches to dispatch",)
+    parser.add_option("-s", "--batch_size", action="store", type="int",
+                      dest="batch_size", default=4,
+                      help="Number of calls in each batch",)
+    parser.add_option("-p", "--n_worker", action="store", type="int",
+                      dest="n_worker", default=4,
+                      help="Number of worker processes",)
+
+    (options, args) = parser.parse_args()
+
+    shared = worker_pool.WorkerPool(processes=options.n_worker,
+                                    preload=["operator"])
+    # each stack reports when it finishes
+    sys.stdout = open(os.devnull, "w")
+    try:
+        per_batch_new = time_batches(options.n_batches, options.batch_size,
+                                     options.n_worker)
+        per_batch_shared = time_batches(options.n_batches,
+                                        options.batch_size,
+                                        options.n_worker, pool=shared)
+    finally:
+        sys.stdout = sys.__stdout__
+        shared.shutdown()
+
+    print "new pool per batch: %10.3f ms/batch" % (per_batch_new * 1000.)
+    print "shared WorkerPool:  %10.3f ms/batch" % (per_batch_shared * 1000.)
@@ -1,18 +1,148 @@
+import functools
 import multiprocessing
+import os
 import shelve
+import traceback
 import utils
 import time
+import fingerprint
+import shared_arrays
+import runtime_history
+import worker_pool
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# ways to run a call stack, see AggregateOutputs.multiprocess_stack
+BACKENDS = ("process", "thread", "serial")
 # TODO make this work with hdf5 files across multiple nodes
 # each function call required to write one hd5 "outfile"
 
 
-def _function_wrapper(args_package):
+class TaskFailure(object):
+    r"""The exception raised by a call in the stack, in place of its result
+
+    `args_package` is the call as packaged by AggregateOutputs.execute,
+    `exc_type` and `message` describe the last exception raised,
+    `traceback` is its formatted traceback from the worker and `attempts`
+    is the number of times the call was tried.
+    """
+    def __init__(self, args_package, exc_type, message, traceback_text,
+                 attempts):
+        self.args_package = args_package
+        self.exc_type = exc_type
+        self.message = message
+        self.traceback = traceback_text
+        self.attempts = attempts
+
+    @property
+    def execute_key(self):
+        return self.args_package[0]
+
+    def __repr__(self):
+        return "TaskFailure(%r, %s: %s, attempts=%d)" % \
+               (self.execute_key, self.exc_type, self.message, self.attempts)
+
+
+class StackResult(dict):
+    r"""Results of a call stack keyed by execute_key; the calls that raised
+    are in `failures`, a dict of TaskFailure objects by execute_key.
+    """
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self.failures = {}
+
+
+def _function_wrapper(args_package, retries=0, backoff=1., history=None,
+                      shared=False):
     """helper to wrap function evaluation
-    TODO: use multiprocessing logger in case of error?
-    multiprocessing.get_logger().error("f%r failed" % (arg_kwargs,))
+
+    An exception in the call is retried up to `retries` times, waiting
+    `backoff` seconds before the first retry and doubling the wait for each
+    one after that. If all attempts fail, the result is a TaskFailure and
+    the traceback is logged to the multiprocessing logger.
+
+    The runtime of a successful call is added to the RuntimeHistory
+    `history`, if given. `shared` is set if the arguments may hold
+    shared_arrays handles.
     """
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            (execute_key, funcname, args, kwargs) = args_package
+            if shared:
+                (args, kwargs) = shared_arrays.restore((args, kwargs))
+
+            start = time.time()
+            result = utils.func_exec(funcname, args, kwargs)
+            if history is not None:
+                history.record(funcname, _history_key(funcname, args, kwargs),
+                               time.time() - start)
+
+            return (args_package, result)
+        except Exception, exception:
+            if attempt <= retries:
+                time.sleep(backoff * 2 ** (attempt - 1))
+                continue
+
+            return (args_package,
+                    _task_failure(args_package, exception,
+                                  traceback.format_exc(), attempt))
+
+
+def _task_failure(args_package, exception, traceback_text, attempts):
+    r"""log a call that failed for good and return its TaskFailure"""
     (execute_key, funcname, args, kwargs) = args_package
-    return (args_package, utils.func_exec(funcname, args, kwargs))
+    multiprocessing.get_logger().error(
+        "%s failed after %d attempt(s):\n%s" %
+        (utils.readable_call(funcname, args, kwargs, maxlen=80),
+         attempts, traceback_text))
+
+    return TaskFailure(args_package, type(exception).__name__,
+                       str(exception), traceback_text, attempts)
+
+
+def _history_key(funcname, args, kwargs):
+    r"""key of a call in a RuntimeHistory (the arguments are restored)"""
+    return fingerprint.call_identifier(funcname, args, kwargs)
+
+
+def print_call(args_package):
+    r"""print the execute_key and a readable form of a packaged call"""
+    (execute_key, funcname, args, kwargs) = args_package
+    readable = utils.readable_call(funcname, args, kwargs, maxlen=80)
+    print "%s: %s" % (execute_key, readable)
+
+
+def _is_hdf5(filename):
+    return os.path.splitext(filename)[1] in (".hdf5", ".hd5", ".h5")
+
+
+def _hdf5_problem(result, path="result"):
+    r"""why `result` cannot be written by h5py_tree (which only records
+    ndarrays and dicts of them), or None if it can
+
+    >>> _hdf5_problem({"a": {"b": np.zeros(3)}}) is None
+    True
+    >>> _hdf5_problem({"a": (1, 2)})
+    "result['a'] is a tuple, not an ndarray or a dict of them"
+    """
+    if np is not None and isinstance(result, np.ndarray):
+        return None
+
+    if isinstance(result, dict):
+        for (key, value) in result.iteritems():
+            problem = _hdf5_problem(value, "%s[%r]" % (path, key))
+            if problem is not None:
+                return problem
+
+        return None
+
+    return "%s is a %s, not an ndarray or a dict of them" % \
+           (path, type(result).__name__)
 
 
 def example_function(arg1, arg2, kwarg=None):
@@ -20,6 +150,13 @@ def example_function(arg1, arg2, kwarg=None):
     return arg1 + arg2, kwarg
 
 
+def example_failing_function(arg1):
+    if arg1 < 0:
+        raise ValueError("negative argument %r" % arg1)
+
+    return arg1
+
+
 class AggregateOutputs(object):
     r"""Spin off a stack of function calls in parallel
 
@@ -30,11 +167,31 @@ class AggregateOutputs(object):
     >>> print test_agg.multiprocess_stack()
     multiprocessing_stack: jobs finished
     {'three': ('a5a6', 'no'), 'two': ('a3a4', 'ok'), 'one': ('a1a2', None)}
+
+    `share_arrays` writes ndarray arguments of at least `share_min_bytes`
+    to shared memory once (see shared_arrays) and passes the workers
+    read-only views instead of a pickled copy per call. The shared files are
+    removed once a stack completes without failures, or at exit.
+
+    `history` is a runtime_history.RuntimeHistory (or True for the default
+    one) in which the runtime of each call is recorded; the calls expected
+    to take longest are then dispatched first and the expected makespan is
+    printed before a stack starts. This fingerprints the arguments of each
+    call, once when the stack is ordered and once in the worker.
     """
-    def __init__(self, funcname, verbose=False):
+    def __init__(self, funcname, verbose=False, share_arrays=False,
+                 share_min_bytes=1 << 20, history=None):
         self.call_stack = []
         self.funcname = funcname
         self.verbose = verbose
+        if history is True:
+            history = runtime_history.RuntimeHistory()
+
+        self.history = history
+        self.exporter = None
+        if share_arrays:
+            self.exporter = shared_arrays.ArrayExporter(
+                                        min_bytes=share_min_bytes)
 
     def execute(self, *args, **kwargs):
         execute_key = kwargs["execute_key"]
@@ -42,67 +199,228 @@ class AggregateOutputs(object):
         # so it does not interfere with the function call.
         del kwargs["execute_key"]
 
+        if self.exporter is not None:
+            (args, kwargs) = self.exporter.share((args, kwargs))
+
         args_package = (execute_key, self.funcname, args, kwargs)
         if self.verbose:
             print_call(args_package)
 
         self.call_stack.append(args_package)
 
+    def _imap(self, **kwargs):
+        r"""yield (args_package, result) pairs as the calls complete, then
+        release the shared arrays if no call failed
+        """
+        failed = False
+        for (args_package, result) in self._dispatch(**kwargs):
+            failed = failed or isinstance(result, TaskFailure)
+            yield (args_package, result)
+
+        # failed calls may be requeued; new calls may share the same arrays
+        if self.exporter is not None and not failed and not self.call_stack:
+            self.exporter.release()
+
+    def _dispatch(self, save_cpu=None, debug=False, ncpu=8, chunksize=1,
+                  retries=0, backoff=1., pool=None, backend="process"):
+        r"""run the call stack on the chosen backend"""
+        if debug:
+            backend = "serial"
+
+        if backend not in BACKENDS:
+            raise ValueError("unknown backend %r, use one of %r" %
+                             (backend, BACKENDS))
+
+        call_stack = self.call_stack
+        # after running the jobs reset the batch
+        self.call_stack = []
+
+        if ncpu:
+            num_cpus = ncpu
+        else:
+            num_cpus = max(multiprocessing.cpu_count() - save_cpu, 1)
+
+        wrapper = functools.partial(_function_wrapper, retries=retries,
+                                    backoff=backoff, history=self.history,
+                                    shared=self.exporter is not None)
+        call = wrapper
+        if debug:
+            def call(item):
+                print item
+                return wrapper(item)
+
+        def history_key(args_package):
+            (execute_key, funcname, args, kwargs) = args_package
+            if self.exporter is not None:
+                (args, kwargs) = shared_arrays.restore((args, kwargs))
+
+            return _history_key(funcname, args, kwargs)
+
+        return worker_pool.imap_stack(call, call_stack, num_cpus,
+                                      chunksize=chunksize, pool=pool,
+                                      backend=backend, history=self.history,
+                                      funcname=self.funcname, key=history_key)
+
+    def requeue(self, failures):
+        r"""put the calls of failed tasks (a dict or list of TaskFailure,
+        e.g. StackResult.failures) back on the call stack
+        """
+        if isinstance(failures, dict):
+            failures = failures.values()
+
+        for failure in failures:
+            self.call_stack.append(failure.args_package)
+
+    def imap_stack(self, save_cpu=None, debug=False, ncpu=8, chunksize=1,
+                   retries=0, backoff=1., pool=None, backend="process"):
+        r"""process the call stack built up by 'execute' calls using
+        multiprocessing, yielding (execute_key, result) pairs in the order
+        the calls complete; the result of a call that raised is a
+        TaskFailure.
+
+        Only the results of calls in flight are held in memory; `chunksize`
+        is the number of calls sent to a worker at a time (larger values
+        cut the overhead for many short calls). Other arguments are as in
+        multiprocess_stack.
+
+        >>> test_agg = AggregateOutputs("aggregate_outputs.example_function")
+        >>> test_agg.execute(1, 2, execute_key="one")
+        >>> test_agg.execute(3, 4, execute_key="two")
+        >>> sorted(test_agg.imap_stack())
+        [('one', (3, None)), ('two', (7, None))]
+        """
+        for (args_package, result) in self._imap(save_cpu=save_cpu,
+                                                 debug=debug, ncpu=ncpu,
+                                                 chunksize=chunksize,
+                                                 retries=retries,
+                                                 backoff=backoff,
+                                                 pool=pool,
+                                                 backend=backend):
+            yield (args_package[0], result)
+
     def multiprocess_stack(self, filename=None, save_cpu=None,
-                           debug=False, ncpu=8):
+                           debug=False, ncpu=8, chunksize=1, retries=0,
+                           backoff=1., pool=None, backend="process"):
         r"""process the call stack built up by 'execute' calls using
         multiprocessing.
 
         `filename` is the output to write the shelve to; in this case, save all
-        the function arguments for recordkeeping.
+        the function arguments for recordkeeping. If `filename` ends in
+        ".hdf5", ".hd5" or ".h5", the results (numpy arrays or dict trees of
+        them) are instead written to that HDF5 file under their execute_key;
+        a result holding anything else is reported as a failure (TypeError)
+        rather than dropped. The output file is replaced, and each result is
+        written as soon as its call completes.
 
         `debug` runs one process at a time because of funny logging/exception
         handling in multiprocessing
 
+        `chunksize` is the number of calls sent to a worker at a time
+
+        `retries` is the number of times a call that raises is tried again,
+        after waiting `backoff` seconds (doubled for each further retry).
+        A call that still fails does not stop the others; it is reported in
+        the `failures` of the returned StackResult and can be put back on
+        the stack with requeue().
+
+        `backend` is how the calls are run:
+            "process": a multiprocessing pool, for CPU-bound calls
+            "thread": a thread pool of `ncpu` threads, for I/O-bound calls
+            (no pickling, results are shared in memory)
+            "serial": one call at a time in this process (as `debug`)
+        All backends give the same results and failure reports.
+
+        `pool` is a worker_pool.WorkerPool (or multiprocessing.Pool) to run
+        the calls in with the "process" or "thread" backend; it is left
+        running for later stacks, so `ncpu` and `save_cpu` are ignored. By
+        default a pool is started for this stack.
+
         Can do either:
         `save_cpu` is the number of CPUs to leave free
         `ncpu` is the number of CPUs to leave free
 
         good for many CPU-heavy processes on one node
-        all results stay in memory
-        """
-        if debug:
-            results = []
-            for item in self.call_stack:
-                print item
-                results.append(_function_wrapper(item))
-        else:
-            if ncpu:
-                num_cpus = ncpu
-            else:
-                num_cpus = multiprocessing.cpu_count() - save_cpu
-
-            pool = multiprocessing.Pool(processes=num_cpus)
-            results = pool.map(_function_wrapper, self.call_stack)
-            pool.close()
-            pool.join()
+        without a `filename`, all results are returned in a StackResult
+        dictionary; with a `filename` it only holds the failures. Use
+        imap_stack to handle results one at a time instead.
 
-        # after running the jobs reset the batch
-        self.call_stack = []
+        >>> test_agg = AggregateOutputs(
+        ...                 "aggregate_outputs.example_failing_function")
+        >>> test_agg.execute(1, execute_key="good")
+        >>> test_agg.execute(-1, execute_key="bad")
+        >>> outcome = test_agg.multiprocess_stack(ncpu=2)
+        multiprocessing_stack: jobs finished
+        multiprocessing_stack: 1 jobs failed: ['bad']
+        >>> outcome, outcome.failures["bad"].exc_type
+        ({'good': 1}, 'ValueError')
+        >>> test_agg.requeue(outcome.failures)
+        >>> test_agg.call_stack
+        [('bad', 'aggregate_outputs.example_failing_function', (-1,), {})]
 
-        print "multiprocessing_stack: jobs finished"
+        >>> test_agg.execute(2, execute_key="good")
+        >>> print test_agg.multiprocess_stack(backend="serial")
+        aggregate_outputs.example_failing_function(-1)
+        aggregate_outputs.example_failing_function(2)
+        multiprocessing_stack: jobs finished
+        multiprocessing_stack: 1 jobs failed: ['bad']
+        {'good': 2}
+        """
+        call_order = [args_package[0] for args_package in self.call_stack]
+        results = self._imap(save_cpu=save_cpu, debug=debug, ncpu=ncpu,
+                             chunksize=chunksize, retries=retries,
+                             backoff=backoff, pool=pool,
+                             backend=backend)
 
-        if filename:
+        outdict = {}
+        stack_result = StackResult()
+        outshelve = None
+        if filename and not _is_hdf5(filename):
             outshelve = shelve.open(filename, "n", protocol=-1)
-            for result_item in results:
-                args_package = result_item[0]
-                execute_key = args_package[0]
-                outshelve[execute_key] = result_item
+        elif filename:
+            import h5py
+            import h5py_tree
 
-            outshelve.close()
-        else:
-            outdict = {}
+            # start a new file, as for the shelve; results are appended
+            h5py.File(filename, "w").close()
+
+        try:
             for result_item in results:
-                args_package = result_item[0]
+                (args_package, result) = result_item
                 execute_key = args_package[0]
-                outdict[execute_key] = result_item[1]
+                if isinstance(result, TaskFailure):
+                    stack_result.failures[execute_key] = result
+                elif outshelve is not None:
+                    if self.exporter is not None:
+                        # record the arguments themselves, not handles
+                        result_item = shared_arrays.restore(result_item)
+
+                    outshelve[execute_key] = result_item
+                elif filename:
+                    problem = _hdf5_problem(result)
+                    if problem is None:
+                        h5py_tree.convert_numpytree_hdf5(
+                                    {execute_key: result}, filename)
+                    else:
+                        stack_result.failures[execute_key] = _task_failure(
+                                    args_package, TypeError(problem), "", 1)
+                else:
+                    outdict[execute_key] = result
+        finally:
+            if outshelve is not None:
+                outshelve.close()
+
+        # fill in the order of the calls rather than of their completion
+        for execute_key in call_order:
+            if execute_key in outdict:
+                stack_result[execute_key] = outdict.pop(execute_key)
+
+        print "multiprocessing_stack: jobs finished"
+        if stack_result.failures:
+            print "multiprocessing_stack: %d jobs failed: %r" % \
+                  (len(stack_result.failures),
+                   sorted(stack_result.failures.keys()))
 
-            return outdict
+        return stack_result
 
 
 if __name__ == "__main__":
@@ -0,0 +1,175 @@
+"""
+Garbage collection for the result stores in cache_store
+
+Records are removed oldest-access first until the store is within a byte
+budget, and any record not accessed within `max_age` seconds is removed.
+A store never removes a record that is being read (see cache_store).
+"""
+import errno
+import fcntl
+import os
+import time
+
+
+def sweep(store, max_bytes=None, max_age=None, verbose=False):
+    r"""Remove least recently used records from `store` until the total size
+    is at most `max_bytes`, and all records older than `max_age` seconds.
+    Returns (number of records removed, bytes freed).
+
+    >>> import tempfile, shutil, cache_store
+    >>> tmpdir = tempfile.mkdtemp()
+    >>> store = cache_store.SQLiteStore(tmpdir + "/cache.sqlite")
+    >>> for identifier in ["a", "b", "c"]:
+    ...     store.save(identifier, {"funcname": "f", "args": (),
+    ...                             "kwargs": {}, "result": "x" * 100}, 0.)
+    >>> sweep(store, max_bytes=300)[0]
+    1
+    >>> sorted(entry[0] for entry in store.entries())
+    ['b', 'c']
+    >>> shutil.rmtree(tmpdir)
+    """
+    entries = sorted(store.entries(), key=lambda entry: entry[2])
+    total_bytes = sum(entry[1] for entry in entries)
+    now = time.time()
+
+    removed = 0
+    freed = 0
+    for (identifier, nbytes, last_access) in entries:
+        expired = max_age is not None and now - last_access > max_age
+        over_budget = max_bytes is not None and total_bytes > max_bytes
+        if not (expired or over_budget):
+            # the remaining records are more recent
+            break
+
+        if store.remove(identifier):
+            if verbose:
+                print "removed %s (%d bytes)" % (identifier, nbytes)
+
+            total_bytes -= nbytes
+            removed += 1
+            freed += nbytes
+        elif verbose:
+            print "skipping %s: in use" % identifier
+
+    return (removed, freed)
+
+
+def _stamp_filename(store):
+    r"""file next to the store whose mtime is the time of the last sweep"""
+    directory = getattr(store, "directory", None)
+    if directory is not None:
+        return os.path.join(directory, ".last_sweep")
+
+    return store.filename + ".last_sweep"
+
+
+class CacheManager(object):
+    r"""Wrap a store so that its budget is enforced as results are written
+
+    The wrapper has the same interface as the store and can be given as
+    `store` to memoize_persistent or MemoizeBatch. sweep() runs with
+    `max_bytes` and `max_age` at most once every `sweep_interval` seconds
+    across all the processes writing to the store: a save checks the time
+    of the last sweep (the mtime of a stamp file next to the store) once per
+    interval, and the process that locks the stamp first does the sweep.
+
+    >>> import tempfile, shutil, cache_store
+    >>> tmpdir = tempfile.mkdtemp()
+    >>> store = CacheManager(cache_store.SQLiteStore(tmpdir + "/c.sqlite"),
+    ...                      max_bytes=300, sweep_interval=3600.)
+    >>> for identifier in ["a", "b", "c", "d"]:
+    ...     store.save(identifier, {"funcname": "f", "args": (),
+    ...                             "kwargs": {}, "result": "x" * 100}, 0.)
+    >>> len(list(store.entries()))
+    4
+    >>> store.maybe_sweep(now=time.time() + 7200.)
+    True
+    >>> len(list(store.entries()))
+    2
+    >>> shutil.rmtree(tmpdir)
+    """
+    def __init__(self, store, max_bytes=None, max_age=None,
+                 sweep_interval=600.):
+        self.store = store
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.sweep_interval = sweep_interval
+        # when this process last looked at the stamp
+        self.last_check = 0.
+
+    def __repr__(self):
+        return "CacheManager(%r, max_bytes=%r, max_age=%r)" % \
+               (self.store, self.max_bytes, self.max_age)
+
+    def location(self, identifier):
+        return self.store.location(identifier)
+
+    def lock_filename(self, identifier):
+        return self.store.lock_filename(identifier)
+
+    def contains(self, identifier):
+        return self.store.contains(identifier)
+
+    def load(self, identifier):
+        return self.store.load(identifier)
+
+    def entries(self):
+        return self.store.entries()
+
+    def remove(self, identifier):
+        return self.store.remove(identifier)
+
+    def save(self, identifier, record, elapsed):
+        self.store.save(identifier, record, elapsed)
+        self.maybe_sweep()
+
+    def maybe_sweep(self, now=None):
+        r"""sweep if no process has in the last `sweep_interval` seconds;
+        True if this call swept
+        """
+        if now is None:
+            now = time.time()
+
+        if now - self.last_check < self.sweep_interval:
+            return False
+
+        self.last_check = now
+        stamp_filename = _stamp_filename(self.store)
+        try:
+            if now - os.stat(stamp_filename).st_mtime < self.sweep_interval:
+                return False
+        except OSError, error:
+            if error.errno != errno.ENOENT:
+                raise
+
+        # a new stamp counts as a sweep, so a new store is first swept one
+        # interval after the first save
+        stamp = open(stamp_filename, "a")
+        try:
+            try:
+                fcntl.flock(stamp.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                # another process is sweeping
+                return False
+
+            # another process may have swept since the check above
+            if now - os.fstat(stamp.fileno()).st_mtime < self.sweep_interval:
+                return False
+
+            self.sweep()
+            os.utime(stamp_filename, (now, now))
+            return True
+        finally:
+            stamp.close()
+
+    def sweep(self, verbose=False):
+        return sweep(self.store, max_bytes=self.max_bytes,
+                     max_age=self.max_age, verbose=verbose)
+
+
+if __name__ == "__main__":
+    import doctest
+
+    OPTIONFLAGS = (doctest.ELLIPSIS |
+                   doctest.NORMALIZE_WHITESPACE)
+    doctest.testmod(optionflags=OPTIONFLAGS)
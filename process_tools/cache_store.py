@@ -0,0 +1,711 @@
+"""
+Result stores for the persistent caches in persistent_memoize and
+memoize_batch
+
+Each cached call has a SHA224 `identifier`. A store saves a record for it
+with the keys "funcname", "args", "kwargs" and "result" (plus anything else
+the caller adds) and the elapsed time of the calculation.
+
+Stores implement:
+location(identifier): human-readable location of the record
+lock_filename(identifier): file to flock while the record is calculated
+    (creating its directory, so callers ask for it only on a miss)
+contains(identifier): True once the record is complete
+load(identifier): return the "result", raise KeyError if there is none
+save(identifier, record, elapsed): write the record atomically
+entries(): yield (identifier, nbytes, last_access) for complete records
+remove(identifier): delete a record unless it is being read; True if removed
+
+load() records the access time at most once per `access_resolution`
+seconds so that hot records do not cost a metadata write on every hit.
+
+With `mmap_arrays`, ndarray leaves of the result (also inside nested
+dicts, lists and tuples) of at least `mmap_min_bytes` are written as raw
+".npy" files next to the record and come back from load() as read-only
+memory maps, so reading a slice of a large result does not read or copy
+the whole array.
+
+With `codec` ("zlib", "bz2" or "lzma"), a pickled result of at least
+`compress_min_bytes` is stored compressed; smaller results are stored as
+they are. Compression applies after memory-mapped arrays are split out.
+"""
+import cPickle as pickle
+import anydbm
+import errno
+import fcntl
+import glob
+import os
+import re
+import shelve
+import socket
+import sqlite3
+import threading
+import time
+import bz2
+import zlib
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+# seconds between updates of the last-access time of a record
+access_resolution = 60.
+
+
+def _write_atomic(filename, contents):
+    r"""Write to a temporary file and rename it into place so that readers
+    never see a partial file.
+    """
+    tmp_filename = "%s.%s.%d.tmp" % (filename, socket.gethostname(),
+                                     os.getpid())
+    tmpfile = open(tmp_filename, "w")
+    tmpfile.write(contents)
+    tmpfile.close()
+    os.rename(tmp_filename, filename)
+
+
+def _makedirs(directory):
+    r"""os.makedirs that tolerates the directory already existing"""
+    try:
+        os.makedirs(directory)
+    except OSError, error:
+        if error.errno != errno.EEXIST:
+            raise
+
+
+_IDENTIFIER_FILE = re.compile(r"^([0-9a-f]{56})\.shelve(.*)$")
+
+
+# marks where an ndarray leaf was moved out of a result into a ".npy" file
+_NPY_TAG = "__cache_store_npy__"
+# marks a result with arrays moved out, so only those are walked on load
+_SPLIT_TAG = "__cache_store_split__"
+
+
+def _split_arrays(tree, arrays, min_bytes):
+    r"""Replace the ndarray leaves of a tree of dicts/lists/tuples by
+    (_NPY_TAG, index) markers; the arrays are appended to `arrays`.
+    """
+    if np is not None and isinstance(tree, np.ndarray):
+        if tree.dtype.hasobject or tree.nbytes < min_bytes:
+            return tree
+
+        arrays.append(tree)
+        return (_NPY_TAG, len(arrays) - 1)
+
+    if type(tree) is dict:
+        return dict((key, _split_arrays(value, arrays, min_bytes))
+                    for (key, value) in tree.iteritems())
+
+    if type(tree) is list:
+        return [_split_arrays(value, arrays, min_bytes) for value in tree]
+
+    if type(tree) is tuple:
+        return tuple(_split_arrays(value, arrays, min_bytes)
+                     for value in tree)
+
+    return tree
+
+
+def _join_arrays(tree, npy_filename):
+    r"""Undo _split_arrays, opening each array as a read-only memory map of
+    the file `npy_filename(index)`.
+    """
+    if type(tree) is tuple and len(tree) == 2 and \
+       isinstance(tree[0], str) and tree[0] == _NPY_TAG:
+        return np.load(npy_filename(tree[1]), mmap_mode="r")
+
+    if type(tree) is dict:
+        return dict((key, _join_arrays(value, npy_filename))
+                    for (key, value) in tree.iteritems())
+
+    if type(tree) is list:
+        return [_join_arrays(value, npy_filename) for value in tree]
+
+    if type(tree) is tuple:
+        return tuple(_join_arrays(value, npy_filename) for value in tree)
+
+    return tree
+
+
+def _save_arrays(result, prefix, min_bytes):
+    r"""Write the ndarray leaves of `result` to "<prefix>.<index>.npy",
+    replacing any from an earlier save; return the result with markers,
+    tagged with _SPLIT_TAG, or the result itself if it had no such leaves.
+    """
+    for npy_filename in glob.glob(prefix + ".*.npy"):
+        os.remove(npy_filename)
+
+    arrays = []
+    skeleton = _split_arrays(result, arrays, min_bytes)
+    if not arrays:
+        return result
+
+    for (index, array) in enumerate(arrays):
+        np.save("%s.%d.npy" % (prefix, index), array)
+
+    return (_SPLIT_TAG, skeleton)
+
+
+def _load_arrays(stored, prefix, identifier):
+    r"""Reattach memory-mapped arrays to a result written by _save_arrays;
+    a KeyError if they were removed in the meantime. Results without split
+    arrays are returned as they are, without walking them.
+    """
+    if not (type(stored) is tuple and len(stored) == 2 and
+            isinstance(stored[0], str) and stored[0] == _SPLIT_TAG):
+        return stored
+
+    try:
+        return _join_arrays(stored[1],
+                            lambda index: "%s.%d.npy" % (prefix, index))
+    except IOError:
+        raise KeyError(identifier)
+
+
+CODECS = {"zlib": (zlib.compress, zlib.decompress),
+          "bz2": (bz2.compress, bz2.decompress)}
+if lzma is not None:
+    CODECS["lzma"] = (lzma.compress, lzma.decompress)
+
+# marks a result that was pickled and compressed
+_ZIP_TAG = "__cache_store_compressed__"
+
+
+def _check_codec(codec):
+    if codec is not None and codec not in CODECS:
+        raise ValueError("unknown or unavailable codec %r; choose from %s" %
+                         (codec, sorted(CODECS)))
+
+
+def _compress(result, codec, min_bytes):
+    r"""Pickle and compress `result` if it is large enough to be worth it
+
+    >>> packed = _compress("x" * 10000, "zlib", 4096)
+    >>> packed[1], len(packed[2]) < 100
+    ('zlib', True)
+    >>> _decompress(packed) == "x" * 10000
+    True
+    >>> _compress("short", "zlib", 4096)
+    'short'
+    """
+    if codec is None:
+        return result
+
+    pickled = pickle.dumps(result, -1)
+    if len(pickled) < min_bytes:
+        return result
+
+    return (_ZIP_TAG, codec, CODECS[codec][0](pickled))
+
+
+def _decompress(stored):
+    r"""Undo _compress"""
+    if type(stored) is tuple and len(stored) == 3 and \
+       isinstance(stored[0], str) and stored[0] == _ZIP_TAG:
+        return pickle.loads(CODECS[stored[1]][1](stored[2]))
+
+    return stored
+
+
+def _open_legacy_lock(filename):
+    r"""Open the file that load() and remove() flock for a shelve written
+    without a ".done" file (older MemoizeBatch caches): the first of its
+    database files in sorted order, which remove() deletes last. None if
+    the record has no database files.
+    """
+    for data_filename in sorted(glob.glob(filename + "*")):
+        if data_filename.endswith((".done", ".busy", ".tmp", ".npy")):
+            continue
+
+        try:
+            return open(data_filename, "r")
+        except IOError:
+            return None
+
+    return None
+
+
+def shard_path(identifier):
+    r"""Subdirectory for an identifier in the sharded layout
+
+    >>> shard_path("12412d7d81bd3bd6c1a86d93ee2ca06f0af35bdfa2a37e86e762557e")
+    '12/41'
+    """
+    return "%s/%s" % (identifier[0:2], identifier[2:4])
+
+
+class ShelveStore(object):
+    r"""One shelve per call in `directory`, "<identifier>.shelve".
+
+    A record is complete once "<identifier>.shelve.done" exists; it holds
+    the elapsed time and is renamed into place after the shelve is closed.
+    Shelves written without a ".done" file (older MemoizeBatch caches) can
+    still be loaded.
+
+    `sharded` places each record in a subdirectory given by the first two
+    pairs of hex digits of its identifier, "ab/cd/<identifier>.shelve", so
+    that no directory grows beyond a few thousand entries. Use
+    migrate_to_sharded to convert a flat cache directory.
+
+    The mtime of the ".done" file is the last access time of the record.
+    Readers hold a shared flock on it while they read the shelve; remove()
+    only deletes a record if it can take an exclusive flock without waiting.
+    Records without a ".done" file are locked the same way on their first
+    database file.
+
+    `mmap_arrays` writes large ndarray leaves of the result to
+    "<identifier>.shelve.<index>.npy" and `codec` compresses the result
+    (see the module notes).
+
+    >>> import tempfile, shutil
+    >>> tmpdir = tempfile.mkdtemp()
+    >>> store = ShelveStore(tmpdir)
+    >>> identifier = "ab" * 28
+    >>> store.contains(identifier)
+    False
+    >>> store.save(identifier, {"funcname": "f", "args": (1,), "kwargs": {},
+    ...                         "result": {"a": [1, 2]}}, 0.5)
+    >>> store.contains(identifier), store.load(identifier)
+    (True, {'a': [1, 2]})
+
+    remove() leaves a record that is being read:
+
+    >>> reader = open(store.location(identifier) + ".done")
+    >>> fcntl.flock(reader.fileno(), fcntl.LOCK_SH)
+    >>> store.remove(identifier)
+    False
+    >>> reader.close()
+    >>> store.remove(identifier), store.contains(identifier)
+    (True, False)
+
+    With `mmap_arrays`, large arrays come back as read-only memory maps:
+
+    >>> store = ShelveStore(tmpdir, mmap_arrays=True, mmap_min_bytes=64)
+    >>> store.save(identifier, {"result": {"x": np.arange(100.), "n": 3}}, 0.)
+    >>> sorted(os.path.basename(name) for name in
+    ...        glob.glob(store.location(identifier) + "*.npy"))
+    ['abab...abab.shelve.0.npy']
+    >>> result = store.load(identifier)
+    >>> type(result["x"]).__name__, result["x"][:3], result["n"]
+    ('memmap', memmap([0., 1., 2.]), 3)
+    >>> result["x"][0] = 1.
+    Traceback (most recent call last):
+    ...
+    ValueError: assignment destination is read-only
+    >>> shutil.rmtree(tmpdir)
+    """
+    def __init__(self, directory, sharded=False, mmap_arrays=False,
+                 mmap_min_bytes=65536, codec=None, compress_min_bytes=4096):
+        _check_codec(codec)
+        self.directory = directory
+        self.sharded = sharded
+        self.mmap_arrays = mmap_arrays
+        self.mmap_min_bytes = mmap_min_bytes
+        self.codec = codec
+        self.compress_min_bytes = compress_min_bytes
+
+    def __repr__(self):
+        return "ShelveStore(%r, sharded=%r)" % (self.directory, self.sharded)
+
+    def location(self, identifier):
+        if self.sharded:
+            filename = "%s/%s/%s.shelve" % (self.directory,
+                                            shard_path(identifier),
+                                            identifier)
+        else:
+            filename = "%s/%s.shelve" % (self.directory, identifier)
+
+        return re.sub('/+', '/', filename)
+
+    def lock_filename(self, identifier):
+        filename = self.location(identifier)
+        if self.sharded:
+            _makedirs(os.path.dirname(filename))
+
+        return filename + ".busy"
+
+    def contains(self, identifier):
+        return os.access(self.location(identifier) + ".done", os.F_OK)
+
+    def load(self, identifier):
+        filename = self.location(identifier)
+        done_filename = filename + ".done"
+        try:
+            lockfile = open(done_filename, "r")
+        except IOError:
+            # older MemoizeBatch caches have no ".done" file
+            lockfile = _open_legacy_lock(filename)
+
+        try:
+            if lockfile is not None:
+                fcntl.flock(lockfile.fileno(), fcntl.LOCK_SH)
+                lock_stat = os.fstat(lockfile.fileno())
+                # removed while waiting for the lock
+                if lock_stat.st_nlink == 0:
+                    raise KeyError(identifier)
+
+                if time.time() - lock_stat.st_mtime > access_resolution:
+                    try:
+                        os.utime(lockfile.name, None)
+                    except OSError:
+                        pass
+
+            try:
+                input_shelve = shelve.open(filename, "r", protocol=-1)
+            except anydbm.error:
+                raise KeyError(identifier)
+
+            try:
+                retval = input_shelve['result']
+            finally:
+                input_shelve.close()
+
+            return _load_arrays(_decompress(retval), filename, identifier)
+        finally:
+            if lockfile is not None:
+                lockfile.close()
+
+    def save(self, identifier, record, elapsed):
+        filename = self.location(identifier)
+        if self.sharded:
+            _makedirs(os.path.dirname(filename))
+
+        record = dict(record)
+        if self.mmap_arrays:
+            record["result"] = _save_arrays(record["result"], filename,
+                                            self.mmap_min_bytes)
+
+        record["result"] = _compress(record["result"], self.codec,
+                                     self.compress_min_bytes)
+
+        outfile = shelve.open(filename, "n", protocol=-1)
+        outfile["filename"] = filename
+        for key, value in record.iteritems():
+            outfile[key] = value
+
+        outfile.close()
+
+        # indicate that the function is done being recalculated
+        _write_atomic(filename + ".done", "%10.15f\n" % elapsed)
+
+    def entries(self):
+        done_mtime = {}
+        data_mtime = {}
+        nbytes = {}
+        in_progress = set()
+        for root, dirs, files in os.walk(self.directory):
+            if not self.sharded:
+                del dirs[:]
+
+            for basename in files:
+                match = _IDENTIFIER_FILE.match(basename)
+                if not match:
+                    continue
+
+                (identifier, suffix) = match.groups()
+                try:
+                    file_stat = os.stat(os.path.join(root, basename))
+                except OSError:
+                    continue
+
+                if suffix == ".done":
+                    done_mtime[identifier] = file_stat.st_mtime
+                elif suffix == ".busy" or suffix.endswith(".tmp"):
+                    in_progress.add(identifier)
+                else:
+                    nbytes[identifier] = nbytes.get(identifier, 0) + \
+                                         file_stat.st_size
+                    data_mtime[identifier] = max(file_stat.st_mtime,
+                                                 data_mtime.get(identifier,
+                                                                0.))
+
+        for identifier in nbytes:
+            if identifier in done_mtime:
+                yield (identifier, nbytes[identifier], done_mtime[identifier])
+            elif identifier not in in_progress:
+                yield (identifier, nbytes[identifier], data_mtime[identifier])
+
+    def remove(self, identifier):
+        filename = self.location(identifier)
+        done_filename = filename + ".done"
+        if os.access(filename + ".busy", os.F_OK):
+            return False
+
+        try:
+            lockfile = open(done_filename, "r")
+        except IOError:
+            lockfile = _open_legacy_lock(filename)
+
+        try:
+            if lockfile is not None:
+                try:
+                    fcntl.flock(lockfile.fileno(),
+                                fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except IOError, error:
+                    if error.errno not in (errno.EAGAIN, errno.EACCES):
+                        raise
+
+                    return False
+
+            if lockfile is not None and lockfile.name == done_filename:
+                # new readers miss from here on
+                os.remove(done_filename)
+
+            # in reverse order, so that the lock of a record without a
+            # ".done" file goes last and readers arriving meanwhile wait on it
+            for data_filename in sorted(glob.glob(filename + "*"),
+                                        reverse=True):
+                if not data_filename.endswith((".busy", ".tmp")):
+                    os.remove(data_filename)
+        finally:
+            if lockfile is not None:
+                lockfile.close()
+
+        return True
+
+
+def migrate_to_sharded(directory, verbose=False):
+    r"""Move the records of a flat ShelveStore `directory` into the sharded
+    layout; returns the number of records moved.
+
+    The shelve files of each record are moved before its ".done" marker, so
+    a record never appears complete in the new location before its data.
+    Records that are being calculated (".busy" or temporary files) are left
+    in place; run the migration again once they finish.
+
+    >>> import tempfile, shutil
+    >>> tmpdir = tempfile.mkdtemp()
+    >>> identifier = "12412d7d" * 7
+    >>> ShelveStore(tmpdir).save(identifier, {"result": 42}, 0.)
+    >>> migrate_to_sharded(tmpdir)
+    1
+    >>> ShelveStore(tmpdir, sharded=True).load(identifier)
+    42
+    >>> os.listdir(tmpdir)
+    ['12']
+    >>> shutil.rmtree(tmpdir)
+    """
+    records = {}
+    busy = set()
+    for filename in os.listdir(directory):
+        match = _IDENTIFIER_FILE.match(filename)
+        if not match:
+            continue
+
+        (identifier, suffix) = match.groups()
+        if suffix == ".busy" or suffix.endswith(".tmp"):
+            busy.add(identifier)
+        else:
+            records.setdefault(identifier, []).append(suffix)
+
+    moved = 0
+    for identifier in sorted(records):
+        if identifier in busy:
+            print "skipping %s: calculation in progress" % identifier
+            continue
+
+        shard_directory = "%s/%s" % (directory, shard_path(identifier))
+        _makedirs(shard_directory)
+
+        # the ".done" marker sorts after the data files it covers
+        suffixes = sorted(records[identifier], key=lambda x: x == ".done")
+        for suffix in suffixes:
+            basename = "%s.shelve%s" % (identifier, suffix)
+            os.rename("%s/%s" % (directory, basename),
+                      "%s/%s" % (shard_directory, basename))
+
+        if verbose:
+            print "%s -> %s" % (identifier, shard_directory)
+
+        moved += 1
+
+    return moved
+
+
+class SQLiteDatabase(object):
+    r"""Per-thread connections to the SQLite database `filename`, opened in
+    `journal_mode` with `timeout` seconds to wait for the write lock; the
+    statements in `schema` are run on each new connection. The object can
+    be pickled and sent to workers, which open their own connections.
+    """
+    schema = ()
+
+    def __init__(self, filename, timeout=60., journal_mode="WAL"):
+        self.filename = filename
+        self.timeout = timeout
+        self.journal_mode = journal_mode
+        self._local = threading.local()
+
+    def __getstate__(self):
+        # connections are per process and per thread
+        state = self.__dict__.copy()
+        del state["_local"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+
+    def _connection(self):
+        r"""return a connection for this thread, opened on first use"""
+        connection = getattr(self._local, "connection", None)
+        if connection is not None and self._local.pid == os.getpid():
+            return connection
+
+        connection = sqlite3.connect(self.filename, timeout=self.timeout,
+                                     isolation_level=None)
+        connection.execute("PRAGMA journal_mode=%s" % self.journal_mode)
+        for statement in self.schema:
+            connection.execute(statement)
+
+        self._local.connection = connection
+        self._local.pid = os.getpid()
+        return connection
+
+
+class SQLiteStore(SQLiteDatabase):
+    r"""All records in one SQLite database `filename`, indexed by identifier.
+
+    The database is opened in `journal_mode` (WAL by default) so that
+    readers do not block the writer. WAL needs all processes on one host;
+    use journal_mode="DELETE" for a database on a network filesystem.
+    Concurrent writers wait up to `timeout` seconds for the write lock.
+
+    Lock files for calculations in progress are kept in "<filename>.locks/"
+    and removed when each calculation finishes.
+
+    `mmap_arrays` writes large ndarray leaves of the result to
+    "<filename>.arrays/<identifier>.<index>.npy" and `codec` compresses the
+    result (see the module notes).
+
+    >>> import tempfile, shutil
+    >>> tmpdir = tempfile.mkdtemp()
+    >>> store = SQLiteStore(tmpdir + "/cache.sqlite")
+    >>> store.contains("abc")
+    False
+    >>> store.save("abc", {"funcname": "f", "args": (1,), "kwargs": {},
+    ...                    "result": [1, 2]}, 0.5)
+    >>> store.contains("abc"), store.load("abc")
+    (True, [1, 2])
+    >>> shutil.rmtree(tmpdir)
+    """
+    schema = ("CREATE TABLE IF NOT EXISTS results ("
+              "identifier TEXT PRIMARY KEY, "
+              "funcname TEXT, "
+              "args BLOB, "
+              "kwargs BLOB, "
+              "result BLOB, "
+              "elapsed REAL, "
+              "created REAL, "
+              "nbytes INTEGER, "
+              "last_access REAL)",
+              "CREATE INDEX IF NOT EXISTS results_funcname "
+              "ON results (funcname)")
+
+    def __init__(self, filename, timeout=60., journal_mode="WAL",
+                 mmap_arrays=False, mmap_min_bytes=65536, codec=None,
+                 compress_min_bytes=4096):
+        _check_codec(codec)
+        super(SQLiteStore, self).__init__(filename, timeout=timeout,
+                                          journal_mode=journal_mode)
+        self.mmap_arrays = mmap_arrays
+        self.mmap_min_bytes = mmap_min_bytes
+        self.codec = codec
+        self.compress_min_bytes = compress_min_bytes
+
+    def __repr__(self):
+        return "SQLiteStore(%r)" % self.filename
+
+    def location(self, identifier):
+        return "%s:%s" % (self.filename, identifier)
+
+    def lock_filename(self, identifier):
+        lock_directory = self.filename + ".locks"
+        _makedirs(lock_directory)
+        return "%s/%s.busy" % (lock_directory, identifier)
+
+    def _array_prefix(self, identifier):
+        return "%s.arrays/%s" % (self.filename, identifier)
+
+    def contains(self, identifier):
+        cursor = self._connection().execute(
+                    "SELECT 1 FROM results WHERE identifier = ?",
+                    (identifier,))
+        return cursor.fetchone() is not None
+
+    def load(self, identifier):
+        connection = self._connection()
+        cursor = connection.execute(
+                    "SELECT result, last_access FROM results "
+                    "WHERE identifier = ?", (identifier,))
+        row = cursor.fetchone()
+        if row is None:
+            raise KeyError(identifier)
+
+        now = time.time()
+        if row[1] is None or now - row[1] > access_resolution:
+            connection.execute("UPDATE results SET last_access = ? "
+                               "WHERE identifier = ?", (now, identifier))
+
+        return _load_arrays(_decompress(pickle.loads(str(row[0]))),
+                            self._array_prefix(identifier), identifier)
+
+    def save(self, identifier, record, elapsed):
+        result = record["result"]
+        nbytes = 0
+        if self.mmap_arrays:
+            prefix = self._array_prefix(identifier)
+            _makedirs(os.path.dirname(prefix))
+            result = _save_arrays(result, prefix, self.mmap_min_bytes)
+            nbytes += sum(os.stat(npy_filename).st_size for npy_filename
+                          in glob.glob(prefix + ".*.npy"))
+
+        result = _compress(result, self.codec, self.compress_min_bytes)
+
+        blobs = [sqlite3.Binary(pickle.dumps(value, -1))
+                 for value in (record["args"], record["kwargs"], result)]
+        nbytes += sum(len(blob) for blob in blobs)
+        now = time.time()
+
+        self._connection().execute(
+            "INSERT OR REPLACE INTO results (identifier, funcname, args, "
+            "kwargs, result, elapsed, created, nbytes, last_access) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (identifier, record["funcname"], blobs[0], blobs[1], blobs[2],
+             elapsed, now, nbytes, now))
+
+    def entries(self):
+        cursor = self._connection().execute(
+                    "SELECT identifier, nbytes, last_access, created "
+                    "FROM results")
+        for (identifier, nbytes, last_access, created) in cursor.fetchall():
+            yield (str(identifier), nbytes or 0, last_access or created)
+
+    def remove(self, identifier):
+        # a reader gets the whole row in one statement, so this never
+        # removes a record in the middle of a read
+        self._connection().execute("DELETE FROM results WHERE identifier = ?",
+                                   (identifier,))
+        for npy_filename in glob.glob(self._array_prefix(identifier) +
+                                      ".*.npy"):
+            os.remove(npy_filename)
+
+        return True
+
+
+if __name__ == "__main__":
+    import doctest
+
+    OPTIONFLAGS = (doctest.ELLIPSIS |
+                   doctest.NORMALIZE_WHITESPACE)
+    doctest.testmod(optionflags=OPTIONFLAGS)
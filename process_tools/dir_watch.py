@@ -0,0 +1,140 @@
+"""
+Watch a directory for new files with Linux inotify (through ctypes)
+
+InotifyWatch(directory) reports the names of files that are closed after
+writing or moved into the directory. Files are not reported when they are
+created, as they may still be incomplete then. It has a fileno() so it
+can be waited on with select(); read() returns the names since the last
+call. Elsewhere (or if inotify cannot be set up) watch() returns None and
+the caller should poll.
+
+Changes made on other hosts of a network filesystem are not reported, so
+callers should still rescan now and then.
+
+>>> import tempfile, shutil, select
+>>> tmpdir = tempfile.mkdtemp()
+>>> watcher = watch(tmpdir)
+>>> if watcher is None:
+...     print ['new.job']
+... else:
+...     open(tmpdir + "/new.tmp", "w").close()
+...     os.rename(tmpdir + "/new.tmp", tmpdir + "/new.job")
+...     ready = select.select([watcher], [], [], 1.)[0]
+...     print sorted(set(watcher.read()) - set(['new.tmp']))
+['new.job']
+>>> shutil.rmtree(tmpdir)
+"""
+import ctypes
+import ctypes.util
+import errno
+import os
+import struct
+import sys
+
+# from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+
+_EVENT_HEADER = struct.Struct("iIII")
+
+_libc = None
+
+
+def _load_libc():
+    r"""return libc with the inotify functions, or None"""
+    global _libc
+    if _libc is None:
+        _libc = False
+        if sys.platform.startswith("linux"):
+            try:
+                libc = ctypes.CDLL(ctypes.util.find_library("c") or
+                                   "libc.so.6", use_errno=True)
+                libc.inotify_init1
+                libc.inotify_add_watch
+            except (OSError, AttributeError):
+                pass
+            else:
+                libc.inotify_add_watch.argtypes = [ctypes.c_int,
+                                                   ctypes.c_char_p,
+                                                   ctypes.c_uint32]
+                _libc = libc
+
+    return _libc or None
+
+
+class InotifyWatch(object):
+    r"""inotify watch on `directory`; raises OSError if it cannot be set up
+    """
+    def __init__(self, directory, mask=IN_CLOSE_WRITE | IN_MOVED_TO):
+        libc = _load_libc()
+        if libc is None:
+            raise OSError(errno.ENOSYS, "inotify is not available")
+
+        self.directory = directory
+        self.overflowed = False
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+
+        if libc.inotify_add_watch(self.fd, directory, mask) < 0:
+            error = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(error, "%s: %s" % (os.strerror(error), directory))
+
+    def fileno(self):
+        return self.fd
+
+    def read(self):
+        r"""names of the files with events since the last call; sets
+        `overflowed` if the kernel dropped events (rescan the directory)
+        """
+        names = []
+        while True:
+            try:
+                buf = os.read(self.fd, 65536)
+            except OSError, error:
+                if error.errno in (errno.EAGAIN, errno.EINTR):
+                    return names
+
+                raise
+
+            offset = 0
+            while offset < len(buf):
+                (wd, mask, cookie, length) = \
+                        _EVENT_HEADER.unpack_from(buf, offset)
+                offset += _EVENT_HEADER.size
+                name = buf[offset:offset + length].rstrip("\0")
+                offset += length
+
+                if mask & IN_Q_OVERFLOW:
+                    self.overflowed = True
+                elif name:
+                    names.append(name)
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+def watch(directory):
+    r"""return an InotifyWatch on `directory`, or None if inotify cannot be
+    used here
+    """
+    try:
+        return InotifyWatch(directory)
+    except OSError:
+        return None
+
+
+if __name__ == "__main__":
+    import doctest
+
+    OPTIONFLAGS = (doctest.ELLIPSIS |
+                   doctest.NORMALIZE_WHITESPACE)
+    doctest.testmod(optionflags=OPTIONFLAGS)
@@ -0,0 +1,249 @@
+"""
+Stable SHA224 fingerprints of function calls, shared by the caching paths
+(memoize_batch, persistent_memoize, scatter_gather)
+
+Arguments are fed to the hash by type rather than pickled:
+ndarrays contribute dtype, shape and their buffer directly; dicts and sets
+are ordered by the digests of their members, so equal contents always give
+the same identifier. Other types are pickled unless a hasher is registered
+for them with register_hasher().
+
+Large immutable objects (strings, hashable tuples, frozensets) enter the
+fingerprint through their own digest. These digests can be memoized with
+enable_memo() so that an argument passed to many calls is only hashed once;
+the identifiers are the same with or without the memo.
+"""
+import cPickle as pickle
+import hashlib
+import os
+import struct
+import threading
+import memoize as memo
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# type: function returning an object to fingerprint in place of the item
+_hashers = {}
+
+# memoized digests of immutable objects; see enable_memo()
+_memo = None
+_memo_lock = threading.Lock()
+# only memoize strings, tuples and frozensets with at least this many items
+memo_min_len = 1024
+
+# absolute filename: (mtime, size, digest) of the file contents
+_file_digests = {}
+
+
+def register_hasher(item_type, hasher):
+    r"""Fingerprint instances of `item_type` (and its subclasses) as
+    `hasher(item)`; the returned object is fingerprinted recursively.
+
+    For example, to key an ndarray subclass on its data and .info dict:
+    register_hasher(algebra.vect, lambda item: (item.view(np.ndarray),
+                                                item.info))
+    """
+    _hashers[item_type] = hasher
+
+
+def enable_memo(maxsize=1024):
+    r"""Memoize fingerprints of immutable objects with at least
+    `memo_min_len` items; maxsize=None disables the memo.
+    """
+    global _memo
+    with _memo_lock:
+        if maxsize is None:
+            _memo = None
+        else:
+            _memo = memo.LRUCache(maxsize=maxsize)
+
+
+def memo_info():
+    r"""hit/miss statistics of the fingerprint memo, None if disabled"""
+    with _memo_lock:
+        if _memo is None:
+            return None
+
+        return _memo.info()
+
+
+def _find_hasher(item):
+    hasher = _hashers.get(type(item))
+    if hasher is not None or not _hashers:
+        return hasher
+
+    for item_type in type(item).__mro__[1:]:
+        if item_type in _hashers:
+            return _hashers[item_type]
+
+    return None
+
+
+def _feed_bytes(hashobj, tag, data):
+    hashobj.update(tag)
+    hashobj.update(struct.pack("<Q", len(data)))
+    hashobj.update(data)
+
+
+def _memo_key(item):
+    r"""key into the memo for large immutable objects, None otherwise"""
+    if not isinstance(item, (str, unicode, tuple, frozenset)) or \
+       len(item) < memo_min_len:
+        return None
+
+    try:
+        hash(item)
+    except TypeError:
+        return None
+
+    return (type(item), item)
+
+
+def _immutable_digest(key, item):
+    r"""digest of a large immutable object, from the memo if enabled"""
+    memo_cache = _memo
+    if memo_cache is not None:
+        with _memo_lock:
+            try:
+                return memo_cache.get(key)
+            except KeyError:
+                pass
+
+    item_hashobj = hashlib.sha224()
+    _feed(item_hashobj, item, nested=False)
+    item_digest = item_hashobj.hexdigest()
+
+    if memo_cache is not None:
+        with _memo_lock:
+            memo_cache.put(key, item_digest)
+
+    return item_digest
+
+
+def _feed(hashobj, item, nested=True):
+    r"""add the fingerprint of `item` to `hashobj`"""
+    hasher = _find_hasher(item)
+    if hasher is not None:
+        hashobj.update("H")
+        _feed(hashobj, hasher(item))
+        return
+
+    if nested:
+        key = _memo_key(item)
+        if key is not None:
+            hashobj.update("M")
+            hashobj.update(_immutable_digest(key, item))
+            return
+
+    if item is None:
+        hashobj.update("N")
+    elif isinstance(item, bool):
+        hashobj.update("T" if item else "F")
+    elif isinstance(item, (int, long)):
+        _feed_bytes(hashobj, "i", str(item))
+    elif isinstance(item, float):
+        _feed_bytes(hashobj, "f", repr(item))
+    elif isinstance(item, str):
+        _feed_bytes(hashobj, "s", item)
+    elif isinstance(item, unicode):
+        _feed_bytes(hashobj, "u", item.encode("utf-8"))
+    elif isinstance(item, (tuple, list)):
+        _feed_bytes(hashobj, "t" if isinstance(item, tuple) else "l",
+                    str(len(item)))
+        for value in item:
+            _feed(hashobj, value)
+    elif isinstance(item, dict):
+        # order by the digests of the keys so any key types can be mixed
+        members = sorted((digest(key), value)
+                         for (key, value) in item.iteritems())
+        _feed_bytes(hashobj, "d", str(len(members)))
+        for (key_digest, value) in members:
+            hashobj.update(key_digest)
+            _feed(hashobj, value)
+    elif isinstance(item, (set, frozenset)):
+        members = sorted(digest(value) for value in item)
+        _feed_bytes(hashobj, "e", "".join(members))
+    elif np is not None and isinstance(item, np.ndarray):
+        if item.dtype.hasobject:
+            _feed_bytes(hashobj, "o", repr(item.shape))
+            _feed(hashobj, item.tolist())
+        else:
+            _feed_bytes(hashobj, "a", "%s %r" % (item.dtype.str, item.shape))
+            if not item.flags.c_contiguous:
+                item = np.ascontiguousarray(item)
+
+            # hash the buffer in place
+            hashobj.update(item)
+    elif np is not None and isinstance(item, np.generic):
+        _feed_bytes(hashobj, "g", item.dtype.str)
+        hashobj.update(item.tostring())
+    else:
+        _feed_bytes(hashobj, "p", pickle.dumps(item, -1))
+
+
+def digest(item):
+    r"""SHA224 hexdigest of a single object
+
+    >>> digest({"a": 1, "b": [1, 2]}) == digest({"b": [1, 2], "a": 1})
+    True
+    >>> digest(1) == digest(1L), digest(1) == digest(1.)
+    (True, False)
+    """
+    hashobj = hashlib.sha224()
+    _feed(hashobj, item)
+    return hashobj.hexdigest()
+
+
+def file_digest(filename):
+    r"""SHA224 hexdigest of the contents of a file; the file is only reread
+    when its path, modification time or size change.
+
+    >>> import tempfile
+    >>> handle = tempfile.NamedTemporaryFile()
+    >>> handle.write("[section]\n"); handle.flush()
+    >>> file_digest(handle.name) == hashlib.sha224("[section]\n").hexdigest()
+    True
+    """
+    filename = os.path.abspath(filename)
+    stat = os.stat(filename)
+    stat_key = (stat.st_mtime, stat.st_size)
+
+    cached = _file_digests.get(filename)
+    if cached is not None and cached[:2] == stat_key:
+        return cached[2]
+
+    hashobj = hashlib.sha224()
+    with open(filename, "rb") as file_handle:
+        for block in iter(lambda: file_handle.read(1 << 20), ""):
+            hashobj.update(block)
+
+    contents_digest = hashobj.hexdigest()
+    _file_digests[filename] = stat_key + (contents_digest,)
+    return contents_digest
+
+
+def call_identifier(funcname, args, kwargs):
+    r"""SHA224 identifier of the call funcname(*args, **kwargs); the order of
+    keyword arguments and of dictionary items does not matter.
+
+    >>> id1 = call_identifier("f", (1, {"x": 1, "y": 2}), {"a": 1, "b": 2})
+    >>> id2 = call_identifier("f", (1, {"y": 2, "x": 1}), {"b": 2, "a": 1})
+    >>> id1 == id2, len(id1)
+    (True, 56)
+    """
+    hashobj = hashlib.sha224()
+    _feed(hashobj, funcname)
+    _feed(hashobj, tuple(args))
+    _feed(hashobj, kwargs or {})
+    return hashobj.hexdigest()
+
+
+if __name__ == "__main__":
+    import doctest
+
+    OPTIONFLAGS = (doctest.ELLIPSIS |
+                   doctest.NORMALIZE_WHITESPACE)
+    doctest.testmod(optionflags=OPTIONFLAGS)
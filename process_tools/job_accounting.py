@@ -0,0 +1,258 @@
+"""
+Resource accounting for the jobs run by process_daemon
+
+A JobMeter measures one job in the worker: the wait from submission to
+start, the wall time, the user and system CPU time (of the worker and any
+children it waited for, from resource.getrusage), the peak resident memory
+and the worker's PID and host. process_daemon stores the result as
+"accounting" in the .done record and appends it as a line of JSON to a
+log in the job directory, which outlives the .done files that gather()
+removes. Each host writes its own log ("accounting.<host>.jsonl" for the
+default `accounting_filename`): appends with O_APPEND do not interleave on
+a local filesystem, but on NFS they can overwrite each other when several
+hosts write one file. read_records() merges the logs of all hosts.
+
+summarize() aggregates the records by function, heaviest first, and reports
+how many workers were kept busy on average, to help choose n_worker:
+
+>>> records = [
+...     {"funcname": "m.slow", "submitted": 0., "started": 1.,
+...      "finished": 11., "queue_wait": 1., "wall_time": 10.,
+...      "user_cpu": 9., "sys_cpu": 0.5, "max_rss": 200 << 20, "pid": 11,
+...      "host": "node1"},
+...     {"funcname": "m.slow", "submitted": 0., "started": 2.,
+...      "finished": 12., "queue_wait": 2., "wall_time": 10.,
+...      "user_cpu": 9., "sys_cpu": 0.5, "max_rss": 300 << 20, "pid": 12,
+...      "host": "node1"},
+...     {"funcname": "m.fast", "submitted": 0., "started": 3.,
+...      "finished": 4., "queue_wait": 3., "wall_time": 1.,
+...      "user_cpu": 0.1, "sys_cpu": 0., "max_rss": 50 << 20, "pid": 11,
+...      "host": "node1"}]
+>>> print summarize(records, n_worker=4)
+function  jobs  wall total  wall mean  cpu/wall  wait mean  wait max  peak RSS
+m.slow       2       20.00      10.00      0.95       1.50      2.00    300.0M
+m.fast       1        1.00       1.00      0.10       3.00      3.00     50.0M
+3 jobs on 2 workers over 11.00 s: 1.91 workers busy on average (47% of 4)
+"""
+import errno
+import glob
+import json
+import os
+import resource
+import shelve
+import socket
+import time
+
+# log of the accounting records in the job directory, one per host with the
+# host name before the extension (None: do not keep)
+accounting_filename = "accounting.jsonl"
+
+
+def _peak_rss():
+    r"""peak resident memory of this process in bytes since the last
+    _reset_peak_rss (where Linux supports that; otherwise since it started)
+    """
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on OS X
+    if os.uname()[0] == "Darwin":
+        return maxrss
+
+    return maxrss * 1024
+
+
+def _reset_peak_rss():
+    r"""reset the peak resident memory of this process (Linux >= 4.0), so
+    that a long-lived worker reports the peak of each job
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as clear_refs:
+            clear_refs.write("5")
+    except IOError:
+        pass
+
+
+def _cpu_times():
+    r"""(user, system) CPU time of this process and its reaped children"""
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return (own.ru_utime + children.ru_utime,
+            own.ru_stime + children.ru_stime)
+
+
+class JobMeter(object):
+    r"""Measure a job from its construction until stop()
+
+    >>> meter = JobMeter(submitted=time.time() - 2.)
+    >>> total = sum(xrange(100000))
+    >>> record = meter.stop()
+    >>> sorted(record.keys())
+    ['finished', 'host', 'max_rss', 'pid', 'queue_wait', 'started', 'submitted', 'sys_cpu', 'user_cpu', 'wall_time']
+    >>> record["queue_wait"] >= 2. and record["pid"] == os.getpid()
+    True
+    """
+    def __init__(self, submitted=None):
+        _reset_peak_rss()
+        self.started = time.time()
+        if submitted is None:
+            submitted = self.started
+
+        self.submitted = submitted
+        self.cpu = _cpu_times()
+
+    def stop(self):
+        r"""the accounting record of the job"""
+        finished = time.time()
+        (user, system) = _cpu_times()
+        return {"submitted": self.submitted,
+                "started": self.started,
+                "finished": finished,
+                "queue_wait": max(self.started - self.submitted, 0.),
+                "wall_time": finished - self.started,
+                "user_cpu": user - self.cpu[0],
+                "sys_cpu": system - self.cpu[1],
+                "max_rss": _peak_rss(),
+                "pid": os.getpid(),
+                "host": socket.gethostname()}
+
+
+def _log_filename(directory, host):
+    r"""accounting log of `host` in `directory`
+
+    >>> _log_filename("jobs", "node1")
+    'jobs/accounting.node1.jsonl'
+    """
+    (root, extension) = os.path.splitext(accounting_filename)
+    return os.path.join(directory, "%s.%s%s" % (root, host, extension))
+
+
+def log_record(directory, record):
+    r"""append an accounting record to this host's log in `directory`"""
+    if accounting_filename is None:
+        return
+
+    line = json.dumps(record, sort_keys=True) + "\n"
+    # a single write with O_APPEND, so the workers on this host do not
+    # interleave lines; other hosts write their own log
+    fd = os.open(_log_filename(directory, socket.gethostname()),
+                 os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+    try:
+        os.write(fd, line)
+    finally:
+        os.close(fd)
+
+
+def read_records(directory):
+    r"""accounting records of the jobs in `directory`: those in the logs of
+    all hosts (and in a single log, as written before there was one per
+    host), or those in the .done files if there is no log
+    """
+    records = []
+    if accounting_filename is not None:
+        log_filenames = glob.glob(_log_filename(directory, "*"))
+        log_filenames.append(os.path.join(directory, accounting_filename))
+        found = False
+        for log_filename in sorted(log_filenames):
+            try:
+                with open(log_filename) as log:
+                    for line in log:
+                        if line.strip():
+                            records.append(json.loads(line))
+            except IOError, error:
+                if error.errno != errno.ENOENT:
+                    raise
+
+                continue
+
+            found = True
+
+        if found:
+            records.sort(key=lambda record: record.get("started"))
+            return records
+
+    for filename in sorted(glob.glob(os.path.join(directory, "*.done"))):
+        jobspec = shelve.open(filename, "r", protocol=-1)
+        try:
+            if "accounting" in jobspec:
+                record = dict(jobspec["accounting"])
+                record.setdefault("funcname", jobspec.get("funcname"))
+                records.append(record)
+        finally:
+            jobspec.close()
+
+    return records
+
+
+def _format_bytes(size):
+    for unit in ("", "K", "M", "G"):
+        if size < 1024:
+            break
+
+        size /= 1024.
+
+    return "%.1f%s" % (size, unit)
+
+
+def summarize(records, n_worker=None):
+    r"""table of the accounting `records` by function, with the functions
+    that took the most wall time first; `n_worker` is the number of
+    workers that were available, to report the fraction kept busy
+    """
+    by_function = {}
+    for record in records:
+        by_function.setdefault(record.get("funcname"), []).append(record)
+
+    width = max([len(str(funcname)) for funcname in by_function] +
+                [len("function")])
+    lines = ["%-*s  jobs  wall total  wall mean  cpu/wall  wait mean  "
+             "wait max  peak RSS" % (width, "function")]
+    totals = [(sum(record["wall_time"] for record in function_records),
+               funcname, function_records)
+              for (funcname, function_records) in by_function.iteritems()]
+    totals.sort(key=lambda item: (-item[0], item[1]))
+    for (wall, funcname, function_records) in totals:
+        njobs = len(function_records)
+        cpu = sum(record["user_cpu"] + record["sys_cpu"]
+                  for record in function_records)
+        waits = [record["queue_wait"] for record in function_records]
+        lines.append("%-*s  %4d  %10.2f  %9.2f  %8.2f  %9.2f  %8.2f  %8s" %
+                     (width, funcname, njobs, wall, wall / njobs,
+                      cpu / max(wall, 1e-9), sum(waits) / njobs, max(waits),
+                      _format_bytes(max(record["max_rss"]
+                                        for record in function_records))))
+
+    if records:
+        span = max(record["finished"] for record in records) - \
+               min(record["started"] for record in records)
+        busy = sum(record["wall_time"] for record in records) / \
+               max(span, 1e-9)
+        workers = len(set((record["host"], record["pid"])
+                          for record in records))
+        line = "%d jobs on %d workers over %.2f s: %.2f workers busy " \
+               "on average" % (len(records), workers, span, busy)
+        if n_worker:
+            line += " (%d%% of %d)" % (100. * busy / n_worker, n_worker)
+
+        lines.append(line)
+
+    return "\n".join(lines)
+
+
+def summarize_directory(directory, n_worker=None):
+    r"""summarize() the jobs run in a job directory"""
+    return summarize(read_records(directory), n_worker=n_worker)
+
+
+if __name__ == "__main__":
+    import doctest
+
+    OPTIONFLAGS = (doctest.ELLIPSIS |
+                   doctest.NORMALIZE_WHITESPACE)
+    doctest.testmod(optionflags=OPTIONFLAGS)
@@ -1,27 +1,334 @@
 import functools
+import collections
+import cPickle as pickle
+import hashlib
+import sys
+import threading
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+CacheInfo = collections.namedtuple("CacheInfo",
+                                   ["hits", "misses", "evictions",
+                                    "maxsize", "maxbytes",
+                                    "currsize", "currbytes"])
+
+
+def estimate_nbytes(value, _seen=None):
+    r"""Estimate the memory held by a cached value: `nbytes` for arrays,
+    the sum over the items of dicts, lists and tuples, and the size of the
+    pickle of other values. Arrays are never pickled, so measuring a large
+    result costs no copy of it; an object held twice is counted once.
+
+    >>> estimate_nbytes("x" * 1000) > 1000
+    True
+    >>> big = np.zeros(1000000)
+    >>> estimate_nbytes({"a": big, "b": (big, [1, 2])}) // 1000000
+    8
+    """
+    if _seen is None:
+        _seen = set()
+
+    if id(value) in _seen:
+        return 0
+
+    if np is not None and isinstance(value, np.ndarray):
+        _seen.add(id(value))
+        return int(value.nbytes)
+
+    if isinstance(value, dict):
+        _seen.add(id(value))
+        return sys.getsizeof(value) + \
+               sum(estimate_nbytes(key, _seen) + estimate_nbytes(item, _seen)
+                   for (key, item) in value.iteritems())
+
+    if isinstance(value, (list, tuple)):
+        _seen.add(id(value))
+        return sys.getsizeof(value) + \
+               sum(estimate_nbytes(item, _seen) for item in value)
+
+    if isinstance(value, (str, unicode, int, long, float, bool, type(None))):
+        return sys.getsizeof(value)
+
+    try:
+        return len(pickle.dumps(value, -1))
+    except (pickle.PicklingError, TypeError):
+        return sys.getsizeof(value)
+
+
+# separates positional from keyword arguments in a cache key
+_KWD_MARK = ("__kwargs__",)
+
+
+def _array_digest(arr):
+    r"""Digest the buffer of an ndarray; C- and Fortran-contiguous arrays are
+    hashed in place without a copy.
+    """
+    if arr.flags.c_contiguous:
+        return "C" + hashlib.sha224(arr).hexdigest()
+
+    if arr.flags.f_contiguous:
+        return "F" + hashlib.sha224(arr.T).hexdigest()
+
+    return "C" + hashlib.sha224(np.ascontiguousarray(arr)).hexdigest()
+
+
+def canonical(item):
+    r"""Convert an argument into a hashable form that compares equal for
+    equal contents: dicts are sorted by key, lists/tuples/dicts are
+    converted recursively and ndarrays become (dtype, shape, digest).
+
+    >>> canonical({"b": [1, 2], "a": {"c": 3}})
+    ('dict', (('a', ('dict', (('c', 3),))), ('b', ('list', (1, 2)))))
+    >>> canonical((1, "x"))
+    (1, 'x')
+    """
+    if np is not None and isinstance(item, np.ndarray):
+        if item.dtype.hasobject:
+            return ("ndarray", item.dtype.str, item.shape,
+                    canonical(item.tolist()))
+
+        return ("ndarray", item.dtype.str, item.shape, _array_digest(item))
+
+    if isinstance(item, dict):
+        return ("dict", tuple(sorted((canonical(key), canonical(value))
+                                     for key, value in item.iteritems())))
+
+    if isinstance(item, (set, frozenset)):
+        return (type(item).__name__,
+                tuple(sorted(canonical(value) for value in item)))
+
+    if isinstance(item, list):
+        return ("list", tuple(canonical(value) for value in item))
+
+    if isinstance(item, tuple):
+        try:
+            hash(item)
+            return item
+        except TypeError:
+            return ("tuple", tuple(canonical(value) for value in item))
+
+    return item
+
+
+def make_key(args, kwargs):
+    r"""Build a cache key from positional and keyword arguments; keyword
+    order does not matter. Raises TypeError if an argument has no hashable
+    canonical form.
+
+    >>> make_key((1, 2), {}) == make_key((1, 2), None)
+    True
+    >>> make_key((1,), {"a": 1, "b": 2}) == make_key((1,), {"b": 2, "a": 1})
+    True
+    """
+    key = canonical(tuple(args))
+    if kwargs:
+        key += _KWD_MARK + tuple(sorted((name, canonical(value))
+                                        for name, value in kwargs.iteritems()))
+
+    hash(key)
+    return key
+
+
+class LRUCache(object):
+    r"""Mapping bounded by entry count and estimated byte size; the least
+    recently used entries are evicted first.
+
+    `maxsize` is the maximum number of entries (None for no limit)
+    `maxbytes` is the maximum of the summed `estimate_nbytes` (None for no
+    limit); a single value larger than this is never stored.
+
+    >>> cache = LRUCache(maxsize=2)
+    >>> cache.put("a", 1)
+    >>> cache.put("b", 2)
+    >>> cache.get("a")
+    1
+    >>> cache.put("c", 3)
+    >>> "b" in cache
+    False
+    >>> cache.info()
+    CacheInfo(hits=1, misses=0, evictions=1, maxsize=2, maxbytes=None,
+              currsize=2, currbytes=0)
+    """
+    def __init__(self, maxsize=None, maxbytes=None):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.clear()
+
+    def clear(self):
+        self._data = collections.OrderedDict()
+        self._nbytes = {}
+        self.currbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        r"""return the cached value for `key` or raise KeyError"""
+        try:
+            value = self._data[key]
+        except KeyError:
+            self.misses += 1
+            raise
+
+        self.hits += 1
+        if self.maxsize is not None or self.maxbytes is not None:
+            # mark as most recently used
+            del self._data[key]
+            self._data[key] = value
+
+        return value
+
+    def put(self, key, value):
+        r"""store `value` under `key`, evicting older entries as needed"""
+        if key in self._data:
+            self._discard(key)
+
+        nbytes = 0
+        if self.maxbytes is not None:
+            nbytes = estimate_nbytes(value)
+            if nbytes > self.maxbytes:
+                return
+
+        self._data[key] = value
+        self._nbytes[key] = nbytes
+        self.currbytes += nbytes
+
+        while (self.maxsize is not None and
+               len(self._data) > self.maxsize) or \
+              (self.maxbytes is not None and
+               self.currbytes > self.maxbytes):
+            oldest = next(iter(self._data))
+            self._discard(oldest)
+            self.evictions += 1
+
+    def _discard(self, key):
+        del self._data[key]
+        self.currbytes -= self._nbytes.pop(key)
+
+    def info(self):
+        return CacheInfo(self.hits, self.misses, self.evictions,
+                         self.maxsize, self.maxbytes,
+                         len(self._data), self.currbytes)
+
+
+class _Flight(object):
+    r"""A computation in progress; other threads asking for the same key wait
+    on `done` and then share its value or exception.
+    """
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.exc_info = None
 
 
 class memoized(object):
     """Decorator that caches a function's return value each time it is called.
 
+    `maxsize` and `maxbytes` bound the cache, see LRUCache; by default the
+    cache grows without limit.
+
+    `threadsafe` guards the cache with a lock and deduplicates concurrent
+    calls: while one thread computes a key the others asking for it wait for
+    its result (or re-raise its exception) instead of computing it again.
+
     Notes:
-    Only args are allowed.
+    Keys are built by `make_key`, so keyword arguments, lists, dicts and
+    ndarrays are cached by content. Other unhashable arguments fall back to
+    calling the function without caching.
+
+    >>> @memoized
+    ... def total(values, scale=1):
+    ...     return sum(values) * scale
+    >>> total([1, 2], scale=2), total([1, 2], scale=2)
+    (6, 6)
+    >>> total.cache_info().hits
+    1
     """
-    def __init__(self, func):
+    def __init__(self, func, maxsize=None, maxbytes=None, threadsafe=False):
         self.func = func
-        self.cache = {}
+        self.cache = LRUCache(maxsize=maxsize, maxbytes=maxbytes)
+        self.threadsafe = threadsafe
+        self._lock = threading.Lock()
+        self._flights = {}
+
+    def __call__(self, *args, **kwargs):
+        if self.threadsafe:
+            return self._call_threadsafe(args, kwargs)
 
-    def __call__(self, *args):
         try:
-            return self.cache[args]
+            key = make_key(args, kwargs)
+            return self.cache.get(key)
         except KeyError:
-            value = self.func(*args)
-            self.cache[args] = value
+            value = self.func(*args, **kwargs)
+            self.cache.put(key, value)
             return value
         except TypeError:
-            # uncachable -- for instance, passing a list as an argument.
+            # uncachable -- for instance, an arbitrary unhashable object.
             # Better to not cache than to blow up entirely.
-            return self.func(*args)
+            return self.func(*args, **kwargs)
+
+    def _call_threadsafe(self, args, kwargs):
+        r"""single-flight version of __call__"""
+        try:
+            key = make_key(args, kwargs)
+        except TypeError:
+            return self.func(*args, **kwargs)
+
+        with self._lock:
+            try:
+                return self.cache.get(key)
+            except KeyError:
+                pass
+
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+
+        if not leader:
+            flight.done.wait()
+            if flight.exc_info is not None:
+                raise flight.exc_info[0], flight.exc_info[1], \
+                      flight.exc_info[2]
+
+            return flight.value
+
+        try:
+            value = self.func(*args, **kwargs)
+        except BaseException:
+            flight.exc_info = sys.exc_info()
+            with self._lock:
+                del self._flights[key]
+
+            flight.done.set()
+            raise
+
+        with self._lock:
+            self.cache.put(key, value)
+            del self._flights[key]
+
+        flight.value = value
+        flight.done.set()
+        return value
+
+    def cache_info(self):
+        """Return hit/miss/eviction counts and the current cache size."""
+        return self.cache.info()
+
+    def cache_clear(self):
+        """Drop all cached values and reset the counters."""
+        with self._lock:
+            self.cache.clear()
 
     def __repr__(self):
         """Return the function's docstring."""
@@ -32,6 +339,25 @@ class memoized(object):
         return functools.partial(self.__call__, obj)
 
 
+def lru_memoized(maxsize=128, maxbytes=None, threadsafe=False):
+    r"""Decorator factory for a memoized function with a bounded cache
+
+    >>> @lru_memoized(maxsize=2)
+    ... def square(x):
+    ...     return x * x
+    >>> [square(x) for x in (1, 2, 1, 3, 2)]
+    [1, 4, 1, 9, 4]
+    >>> square.cache_info()
+    CacheInfo(hits=1, misses=4, evictions=2, maxsize=2, maxbytes=None,
+              currsize=2, currbytes=0)
+    """
+    def decorator(func):
+        return memoized(func, maxsize=maxsize, maxbytes=maxbytes,
+                        threadsafe=threadsafe)
+
+    return decorator
+
+
 @memoized
 def fibonacci(n):
     """Example: return the nth fibonacci number."""
@@ -42,5 +368,11 @@ def fibonacci(n):
 
 
 if __name__ == "__main__":
+    import doctest
+
+    OPTIONFLAGS = (doctest.ELLIPSIS |
+                   doctest.NORMALIZE_WHITESPACE)
+    doctest.testmod(optionflags=OPTIONFLAGS)
+
     print fibonacci(120)
     print fibonacci(120)
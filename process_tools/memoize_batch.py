@@ -1,39 +1,54 @@
-import shelve
 import utils
 import multiprocessing
-import copy
-import cPickle as pickle
-import hashlib
-import re
+import time
+import cache_store
+import fingerprint
+import shared_arrays
+import runtime_history
+import worker_pool
+import functools
+import operator
 
 
-def _function_wrapper(args_package):
+def _function_wrapper(args_package, history=None, shared=False):
     """Allow multiprocessing Pool to call generic functions/args/kwargs.
 
     Data are saved here rather than handed back to avoid the scenario where
-    all of the output from a batch run is held in memory.
+    all of the output from a batch run is held in memory. The runtime is
+    also added to the RuntimeHistory `history`, if given. `shared` is set if
+    the arguments may hold shared_arrays handles.
     """
-    (identifier, directory, funcname, args, kwargs) = args_package
+    (identifier, store, funcname, args, kwargs) = args_package
+    if shared:
+        (args, kwargs) = shared_arrays.restore((args, kwargs))
 
     readable = utils.readable_call(funcname, args, kwargs)
-    filename = "%s/%s.shelve" % (directory, identifier)
-    filename = re.sub('/+', '/', filename)
-    print "%s -> %s" % (readable, filename)
+    print "%s -> %s" % (readable, store.location(identifier))
 
+    start = time.time()
     result = utils.func_exec(funcname, args, kwargs, printcall=False)
 
-    outfile = shelve.open(filename, 'n', protocol=-1)
-    outfile["identifier"] = identifier
-    outfile["filename"] = filename
-    outfile["funcname"] = funcname
-    outfile["args"] = args
-    outfile["kwargs"] = kwargs
-    outfile["result"] = result
-    outfile.close()
+    record = {"identifier": identifier,
+              "funcname": funcname,
+              "args": args,
+              "kwargs": kwargs,
+              "result": result}
+
+    elapsed = time.time() - start
+    store.save(identifier, record, elapsed)
+    if history is not None:
+        history.record(funcname, identifier, elapsed)
 
     return identifier
 
 
+def print_call(args_package):
+    r"""print a readable form of a packaged call and where it is cached"""
+    (identifier, store, funcname, args, kwargs) = args_package
+    readable = utils.readable_call(funcname, args, kwargs, maxlen=80)
+    print "%s -> %s" % (readable, store.location(identifier))
+
+
 class MemoizeBatch(object):
     r"""Manage/cache a large batch of function calls
 
@@ -53,30 +68,28 @@ class MemoizeBatch(object):
     Notes:
     The output from each function call must be serializable. It is saved to a
     file with a unique SHA224 identifier based on its function name, args, and
-    kwargs.
+    kwargs (see fingerprint.call_identifier).
 
     For a function func(arg=True), the identifiers for func(arg=True) and
     func() will be different even if their outputs are the same.
 
-    Dictionaries should not be given as arguments. They are not sorted here and
-    may result in different identifiers for the same arguments. If you are
-    arguments that are json-serializable, consider adding Simplejson's
-    sort_keys=True to allow dictionary arguments. This will not work for numpy.
+    Dictionaries, also nested ones and those holding numpy arrays, are
+    ordered before they are hashed, so they can be given as arguments.
 
     Example to generate the cache table:
     >>> caller1 = MemoizeBatch("memoize_batch.trial_function", "./", generate=True)
     >>> caller1.execute("ok", 3, arg1=True, arg2=3)
-    '12412d7d81bd3bd6c1a86d93ee2ca06f0af35bdfa2a37e86e762557e'
+    'bdd36ab5912f6b3462ef77fc886de3ec697945f3d8339f73f0c11168'
     >>> import numpy as np
     >>> bins = np.arange(0,1, 0.2)
     >>> caller1.execute(5, "ok2", arg1="stringy", arg2=bins)
-    'a4bcca2aa43785944dfaf4ef692931e274956ab11ee7b48c6cbf6a59'
+    '4f61b36a6f6c2373347469d385bd9f6d1296f56f11cb0dfff8ff4174'
     >>> caller1.execute("ok2",4)
-    '103a79b6e8a44796ad1b4657c3de31ee38cabc0f1a2810667a297ae4'
+    '4c2140e388c0af746210a0f6c6c708eef208d44e633c109ea341f7cb'
     >>> caller1.multiprocess_stack()
-    ['12412d7d81bd3bd6c1a86d93ee2ca06f0af35bdfa2a37e86e762557e',
-     'a4bcca2aa43785944dfaf4ef692931e274956ab11ee7b48c6cbf6a59',
-     '103a79b6e8a44796ad1b4657c3de31ee38cabc0f1a2810667a297ae4']
+    ['bdd36ab5912f6b3462ef77fc886de3ec697945f3d8339f73f0c11168',
+     '4f61b36a6f6c2373347469d385bd9f6d1296f56f11cb0dfff8ff4174',
+     '4c2140e388c0af746210a0f6c6c708eef208d44e633c109ea341f7cb']
 
     Example to use the cache in later computation:
     >>> caller2 = MemoizeBatch("memoize_batch.trial_function", "./")
@@ -87,12 +100,16 @@ class MemoizeBatch(object):
     >>> caller2.execute("ok2",4)
     ('ok2', 4, 'e', 'r')
 
-    TODO:
-    add regenerate mode?
-    assigning run ids to dictionaries of numpy objects: .tolist and json?,
-    nested sort + pickle?
+    Running the stack again only computes calls that are not cached yet:
+    >>> caller1.execute("ok3", 5)
+    '...'
+    >>> caller1.multiprocess_stack()
+    skipping 3 cached or repeated calls
+    ['...']
     """
-    def __init__(self, funcname, directory, generate=False, verbose=False):
+    def __init__(self, funcname, directory, generate=False, verbose=False,
+                 store=None, sharded=False, codec=None, share_arrays=False,
+                 share_min_bytes=1 << 20, history=None):
         r"""
         funcname: string
             the function name pointer in one of the forms
@@ -103,35 +120,67 @@ class MemoizeBatch(object):
 
         generate: boolean
             choose this to generate the result cache
+
+        store: cache_store object
+            where results are saved; by default a ShelveStore in
+            `directory`; use cache_store.SQLiteStore for a single database
+
+        sharded: boolean
+            use the "ab/cd/<identifier>" layout for the default ShelveStore
+
+        codec: string
+            compress large results in the default ShelveStore with "zlib",
+            "bz2" or "lzma"
+
+        share_arrays: boolean
+            write ndarray arguments of at least `share_min_bytes` to shared
+            memory once (see shared_arrays) and pass the workers read-only
+            views instead of a pickled copy per call; the shared files are
+            written when a stack is run and removed when it finishes
+
+        history: runtime_history.RuntimeHistory
+            record the runtime of each call (keyed by its identifier) and
+            dispatch the calls expected to take longest first, printing the
+            expected makespan; True uses the default history database
         """
         self.funcname = funcname
         self.directory = directory
+        if store is None:
+            store = cache_store.ShelveStore(directory, sharded=sharded,
+                                            codec=codec)
+
+        self.store = store
         self.call_stack = []
         self.generate = generate
         self.verbose = verbose
+        self.exporter = None
+        if share_arrays:
+            self.exporter = shared_arrays.ArrayExporter(
+                                        min_bytes=share_min_bytes)
+
+        if history is True:
+            history = runtime_history.RuntimeHistory()
+
+        self.history = history
 
     def execute(self, *args, **kwargs):
         r"""Generate or access data from the function call.
 
         Note:
-        If an "inifile" is one of the function arguments, read that and include
-        it in the checksum for the function call identifier.
-
-        also see stackoverflow's: computing-an-md5-hash-of-a-data-structure
-        based on: how-to-memoize-kwargs
+        If an "inifile" is one of the function arguments, the digest of its
+        contents replaces the filename in the function call identifier. The
+        digest is cached on the file's path, mtime and size, so repeated
+        calls with the same inifile do not reread it.
         """
-        kwini = copy.deepcopy(kwargs)
+        kwini = kwargs
         if "inifile" in kwargs:
-            open_inifile = open(kwargs["inifile"], "r")
-            kwini["inifile"] = "".join(open_inifile.readlines())
-            open_inifile.close()
-
-        argpkl = pickle.dumps((self.funcname, args,
-                               tuple(sorted(kwini.items()))), -1)
+            # shallow copy: only the inifile entry is replaced
+            kwini = dict(kwargs)
+            kwini["inifile"] = fingerprint.file_digest(kwargs["inifile"])
 
-        identifier = hashlib.sha224(argpkl).hexdigest()
+        identifier = fingerprint.call_identifier(self.funcname, args, kwini)
 
-        args_package = (identifier, self.directory,
+        args_package = (identifier, self.store,
                         self.funcname, args, kwargs)
 
         if self.verbose:
@@ -142,32 +191,100 @@ class MemoizeBatch(object):
             retval = identifier
         else:
             # TODO: raise NotCalculated?
-            filename = "%s/%s.shelve" % (self.directory, identifier)
-            filename = re.sub('/+', '/', filename)
-            input_shelve = shelve.open(filename, "r", protocol=-1)
-            retval = input_shelve['result']
-            input_shelve.close()
+            retval = self.store.load(identifier)
 
         return retval
 
-    def multiprocess_stack(self, save_cpu=4, debug=False):
+    def pending_stack(self, force=False):
+        r"""Return the entries of the call stack that still need to be run:
+        calls that are already complete in the store are dropped (unless
+        `force`) along with repeated calls.
+        """
+        pending = []
+        seen = set()
+        for args_package in self.call_stack:
+            identifier = args_package[0]
+            if identifier in seen:
+                continue
+
+            seen.add(identifier)
+            if force or not self.store.contains(identifier):
+                pending.append(args_package)
+
+        return pending
+
+    def imap_stack(self, save_cpu=4, debug=False, force=False, chunksize=1,
+                   pool=None):
+        r"""process the call stack as multiprocess_stack does, yielding
+        (identifier, identifier) pairs in the order the calls complete; the
+        results themselves are written to the store by the workers.
+        `chunksize` is the number of calls sent to a worker at a time.
+        """
+        call_stack = self.pending_stack(force=force)
+        num_skipped = len(self.call_stack) - len(call_stack)
+        if num_skipped:
+            print "skipping %d cached or repeated calls" % num_skipped
+
+        if not call_stack:
+            return
+
+        wrapper = functools.partial(_function_wrapper, history=self.history,
+                                    shared=self.exporter is not None)
+        if debug:
+            backend = "serial"
+        else:
+            backend = "process"
+
+        try:
+            if self.exporter is not None:
+                call_stack = [(identifier, store, funcname) +
+                              self.exporter.share((args, kwargs))
+                              for (identifier, store, funcname, args, kwargs)
+                              in call_stack]
+
+            for identifier in worker_pool.imap_stack(
+                        wrapper, call_stack,
+                        max(multiprocessing.cpu_count() - save_cpu, 1),
+                        chunksize=chunksize, pool=pool, backend=backend,
+                        history=self.history, funcname=self.funcname,
+                        key=operator.itemgetter(0)):
+                yield (identifier, identifier)
+        finally:
+            # the call stack keeps the arrays, so a rerun shares them again
+            if self.exporter is not None:
+                self.exporter.release()
+
+    def multiprocess_stack(self, save_cpu=4, debug=False, force=False,
+                           chunksize=1, pool=None):
         r"""process the call stack built up by 'execute' calls using
         multiprocessing.
         `save_cpu` is the number of CPUs to leave free
         `debug` runs one process at a time because of funny logging/exception
         handling in multiprocessing
+        `force` recomputes calls whose results are already in the cache;
+        otherwise only the missing ones are run, so an interrupted or
+        extended batch can be resumed. A result counts as cached once the
+        store has committed it (for a ShelveStore, once its ".done" file is
+        in place).
+        `chunksize` is the number of calls sent to a worker at a time
+        `pool` is a worker_pool.WorkerPool (or multiprocessing.Pool) to run
+        the calls in; it is left running for later stacks and `save_cpu` is
+        ignored. By default a pool is started for this stack.
+
+        Results are saved by the workers as they complete; only their
+        identifiers are handed back, in call stack order.
         """
-        if debug:
-            result = []
-            for item in self.call_stack:
-                print_call(item)
-                result.append(_function_wrapper(item))
-        else:
-            num_cpus = multiprocessing.cpu_count() - save_cpu
-            pool = multiprocessing.Pool(processes=num_cpus)
-            result = pool.map(_function_wrapper, self.call_stack)
-            pool.close()
-            pool.join()
+        completed = set(identifier for (identifier, _) in
+                        self.imap_stack(save_cpu=save_cpu, debug=debug,
+                                        force=force, chunksize=chunksize,
+                                        pool=pool))
+
+        result = []
+        for args_package in self.call_stack:
+            identifier = args_package[0]
+            if identifier in completed:
+                result.append(identifier)
+                completed.discard(identifier)
 
         print result
 
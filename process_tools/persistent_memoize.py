@@ -1,125 +1,388 @@
 import cPickle as pickle
+import errno
+import fcntl
 import hashlib
-import random
+import socket
 import time
-import shelve
 import functools
 import os
 import utils
-import re
+import fingerprint
+import memoize as memo
+import cache_store
+import threading
 
 
-def _make_serializable(item):
-    """repackage an object so that it can be pickle.dumps()"""
-    return item
+memoize_directory = "./"
+# write the default ShelveStore in the "ab/cd/<identifier>" layout
+memoize_sharded = False
+# seconds without a heartbeat before a ".busy" owner is presumed dead
+stale_timeout = 300.
+# seconds between heartbeats of the process calculating a result
+heartbeat_interval = 10.
+# longest wait between polls for a lock held on another host
+lock_poll_max = 0.05
+
+
+def _pid_alive(pid):
+    r"""check whether a process on this host exists"""
+    try:
+        os.kill(pid, 0)
+    except OSError, error:
+        return error.errno != errno.ESRCH
 
+    return True
+
+
+def _owner_is_stale(busy_filename):
+    r"""Decide whether the owner of a ".busy" file is gone: either its
+    heartbeat (the file mtime) is older than `stale_timeout`, or it ran on
+    this host and its PID no longer exists.
+    """
+    try:
+        mtime = os.stat(busy_filename).st_mtime
+        busyfile = open(busy_filename, "r")
+        owner = busyfile.read().split()
+        busyfile.close()
+    except (IOError, OSError):
+        return False
+
+    if time.time() - mtime > stale_timeout:
+        return True
+
+    if len(owner) == 3 and owner[0] == socket.gethostname():
+        return not _pid_alive(int(owner[1]))
+
+    return False
+
+
+def _owner_is_local(busy_filename):
+    r"""True if the ".busy" file was claimed by a process on this host"""
+    try:
+        busyfile = open(busy_filename, "r")
+        owner = busyfile.read().split()
+        busyfile.close()
+    except IOError:
+        return False
+
+    return len(owner) == 3 and owner[0] == socket.gethostname()
+
+
+def _lock_exclusive(lock_filename):
+    r"""Open `lock_filename` and take an exclusive flock on it, waiting for
+    any other holder to release it. The previous holder removes the file
+    before releasing it, so retry until the lock is held on the file that is
+    currently at that path.
+
+    If the lock is held by a live process on this host, block on it: the
+    kernel releases it as soon as the holder finishes or dies. Otherwise
+    (e.g. another node on a shared filesystem) poll with exponential backoff
+    up to `lock_poll_max` seconds, and take over the lock if its owner is
+    stale.
+    """
+    delay = 0.001
+    while True:
+        lockfile = open(lock_filename, "a")
+        try:
+            fcntl.flock(lockfile.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError, error:
+            if error.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+
+            if _owner_is_stale(lock_filename):
+                print "taking over stale lock %s" % lock_filename
+                _remove_if_same(lockfile, lock_filename)
+                lockfile.close()
+                continue
+
+            if _owner_is_local(lock_filename):
+                fcntl.flock(lockfile.fileno(), fcntl.LOCK_EX)
+            else:
+                lockfile.close()
+                time.sleep(delay)
+                delay = min(2. * delay, lock_poll_max)
+                continue
+
+        try:
+            if os.fstat(lockfile.fileno()).st_ino == \
+               os.stat(lock_filename).st_ino:
+                return lockfile
+        except OSError:
+            pass
+
+        lockfile.close()
+
+
+def _remove_if_same(lockfile, lock_filename):
+    r"""Remove `lock_filename` only if it is still the file open as
+    `lockfile`; after a takeover it belongs to the new owner.
+    """
+    try:
+        if os.fstat(lockfile.fileno()).st_ino == \
+           os.stat(lock_filename).st_ino:
+            os.remove(lock_filename)
+    except OSError:
+        pass
+
+
+def _claim(lockfile):
+    r"""Record this process as the owner of a held ".busy" lock"""
+    lockfile.truncate(0)
+    lockfile.write("%s %d %10.6f\n" % (socket.gethostname(), os.getpid(),
+                                        time.time()))
+    lockfile.flush()
+
+
+def _unlock(lockfile, lock_filename):
+    r"""Remove the lock file and then release the lock"""
+    _remove_if_same(lockfile, lock_filename)
+    lockfile.close()
+
+
+class _Heartbeat(threading.Thread):
+    r"""Touch the ".busy" file every `interval` seconds while the result is
+    being calculated so that waiters can tell a live owner from a dead one.
+    """
+    def __init__(self, filename, interval):
+        super(_Heartbeat, self).__init__()
+        self.daemon = True
+        self.filename = filename
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                os.utime(self.filename, None)
+            except OSError:
+                pass
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
 
-memoize_directory = "./"
 
+def memoize_persistent(func=None, l1_maxsize=None, l1_maxbytes=None,
+                       store=None, codec=None):
+    r"""Memoize with a persistent cache.
 
-def memoize_persistent(func):
-    """Memoize with a persistent cache.
+    `store` is where results are saved (see cache_store), by default a
+    ShelveStore in `memoize_directory` (sharded if `memoize_sharded`);
+    cache_store.SQLiteStore keeps the whole cache in one indexed database
+    file. `codec` ("zlib", "bz2" or "lzma") compresses large results in the
+    default store.
+
+    `l1_maxsize` and/or `l1_maxbytes` enable an in-process LRU cache (see
+    memoize.LRUCache) keyed by the same identifier in front of the files, so
+    repeated calls in one process do not touch the filesystem. The L1 cache
+    returns the same object on every hit rather than a fresh copy from disk.
+    Its statistics are available through `.cache_info()` and it is emptied
+    by `.cache_clear()` on the decorated function.
+
+    Use as @memoize_persistent or @memoize_persistent(l1_maxsize=1000).
 
     Notes:
     The cache files are uniquely specified with a SHA224 hash based on their
-    arguments and function call name.
-
-    Keyword arguments are an unsorted dict; sort them to memoize consistently
+    arguments and function call name, see fingerprint.call_identifier.
+    Keyword arguments and dictionaries are ordered, so equal calls always
+    share a cache entry.
 
-    All inputs/outputs must be serializable with protocol=-1; otherwise,
-    write a wrapper.
+    All outputs must be serializable with protocol=-1; for arguments that
+    cannot be pickled, register a hasher with fingerprint.register_hasher.
 
     This is designed to work with multiple processes. Procedure:
-    If the requested result does not exist, or is being calculated, write a
-    lock ".busy" file and begin the calculation, save it to a new file,
-    and return the result.
+    A result is complete once the store commits it; for the ShelveStore,
+    once its ".done" file exists. This is written to a temporary file and
+    renamed into place after the result shelve is closed, so a cache hit is
+    one check of the ".done" file plus the shelve read.
+
+    If the result is not complete, take an exclusive flock on the ".busy"
+    file. This blocks while another process/thread computes the same result
+    and returns as soon as it releases the lock. Once the lock is held, check
+    again for the result; if it is still missing, calculate the result,
+    save it and release the lock.
+
+    The ".busy" file records the owner "host pid start_time" and its mtime is
+    refreshed every `heartbeat_interval` seconds. If the owner's PID is gone
+    (same host) or its heartbeat is older than `stale_timeout`, a waiter
+    takes over the lock and calculates the result itself.
+
+    >>> import tempfile, shutil
+    >>> tmpdir = tempfile.mkdtemp()
+    >>> store = cache_store.ShelveStore(tmpdir)
+    >>> calls = []
+    >>> def square(x):
+    ...     calls.append(x)
+    ...     return x * x
+    >>> cached_square = memoize_persistent(square, store=store)
+    >>> cached_square(3)
+    square(3) -> ...
+    no cache, recalculating ...
+    9
+    >>> cached_square(3)
+    square(3) -> ...
+    used cached value ...
+    9
+
+    A second caller waits while the lock is held and then reads the result
+    instead of calculating it again:
+
+    >>> identifier = fingerprint.call_identifier("square", (4,), {})
+    >>> busy_filename = store.lock_filename(identifier)
+    >>> busyfile = _lock_exclusive(busy_filename)
+    >>> _claim(busyfile)
+    >>> waited = []
+    >>> waiter = threading.Thread(target=lambda: waited.append(cached_square(4)))
+    >>> waiter.start(); time.sleep(0.5)
+    square(4) -> ...
+    >>> store.save(identifier, {"result": 16}, 0.)
+    >>> _unlock(busyfile, busy_filename)
+    >>> waiter.join(); waited
+    used value cached while waiting ...
+    [16]
+
+    A lock whose owner on another host stopped its heartbeat is taken over:
+
+    >>> identifier = fingerprint.call_identifier("square", (5,), {})
+    >>> busy_filename = store.lock_filename(identifier)
+    >>> deadfile = open(busy_filename, "w")
+    >>> fcntl.flock(deadfile.fileno(), fcntl.LOCK_EX)
+    >>> deadfile.write("otherhost 1 0.0\n"); deadfile.flush()
+    >>> os.utime(busy_filename, (0., time.time() - 2. * stale_timeout))
+    >>> cached_square(5)
+    square(5) -> ...
+    taking over stale lock ...
+    no cache, recalculating ...
+    25
+    >>> deadfile.close()
+    >>> calls
+    [3, 5]
+
+    With an L1 cache, repeated calls are answered in the process:
+
+    >>> l1_square = memoize_persistent(square, l1_maxsize=10, store=store)
+    >>> l1_square(3)
+    square(3) -> ...
+    used cached value ...
+    9
+    >>> l1_square(3)
+    9
+    >>> l1_square.cache_info()
+    CacheInfo(hits=1, misses=1, evictions=0, maxsize=10, maxbytes=None, currsize=1, currbytes=...)
+    >>> l1_square.cache_clear()
+    >>> l1_square.cache_info().currsize
+    0
+    >>> shutil.rmtree(tmpdir)
+    """
+    if func is None:
+        return functools.partial(memoize_persistent, l1_maxsize=l1_maxsize,
+                                 l1_maxbytes=l1_maxbytes, store=store,
+                                 codec=codec)
 
-    If the requested result exists, read the file and return it.
+    l1_cache = None
+    if l1_maxsize is not None or l1_maxbytes is not None:
+        l1_cache = memo.LRUCache(maxsize=l1_maxsize, maxbytes=l1_maxbytes)
 
-    If the requested results is being calculated in another process/thread,
-    wait until it finishes; load the output and return it.
+    l1_lock = threading.Lock()
 
-    TODO:
-    better thread safety or SQLite?
-    """
     def memoize(*args, **kwargs):
         funcname = func.__name__
-        rehashed = [_make_serializable(item) for item in args]
-
-        argpkl = pickle.dumps((funcname, rehashed,
-                               tuple(sorted(kwargs.items()))), -1)
+        identifier = fingerprint.call_identifier(funcname, args, kwargs)
 
-        identifier = hashlib.sha224(argpkl).hexdigest()
+        if l1_cache is None:
+            return cached_call(identifier, funcname, args, kwargs)
 
-        readable = utils.readable_call(funcname, rehashed, kwargs)
-        filename = "%s/%s.shelve" % (memoize_directory, identifier)
-        filename = re.sub('/+', '/', filename)
-        print "%s -> %s" % (readable, filename)
+        with l1_lock:
+            try:
+                return l1_cache.get(identifier)
+            except KeyError:
+                pass
 
-        done_filename = filename + ".done"
-        busy_filename = filename + ".busy"
+        retval = cached_call(identifier, funcname, args, kwargs)
+        with l1_lock:
+            l1_cache.put(identifier, retval)
 
-        # prevent the race condition where many threads want to
-        # start writing a new cache file at the same time
-        time.sleep(random.uniform(0, 0.5))
+        return retval
 
-        # if the result is cahced or being calculated elsewhere,
-        if os.access(done_filename, os.F_OK) or \
-           os.access(busy_filename, os.F_OK):
-            printed = False
-            # wait for the other calculation process to finish
-            while(not os.access(done_filename, os.F_OK)):
-                time.sleep(1.)
-                if not printed:
-                    print "waiting for %s" % filename
-                    printed = True
+    def cached_call(identifier, funcname, args, kwargs):
+        r"""look up or calculate the result in the persistent store"""
+        if store is None:
+            result_store = cache_store.ShelveStore(memoize_directory,
+                                                   sharded=memoize_sharded,
+                                                   codec=codec)
+        else:
+            result_store = store
 
-            # if many threads were waiting to read, space their reads
-            time.sleep(random.uniform(0, 0.5))
+        readable = utils.readable_call(funcname, args, kwargs)
+        filename = result_store.location(identifier)
+        print "%s -> %s" % (readable, filename)
 
-            print "ready to read %s" % filename
+        # if the result is cached, read it; a cache sweep may remove it
+        # between the check and the read
+        if result_store.contains(identifier):
             try:
-                input_shelve = shelve.open(filename, "r", protocol=-1)
-                retval = input_shelve['result']
-                input_shelve.close()
+                retval = result_store.load(identifier)
                 print "used cached value %s" % filename
-            except:
-                raise ValueError
-        else:
-            # first flag the cachefile as busy so other threads wait
-            busyfile = open(busy_filename, "w")
-            busyfile.write("working")
-            busyfile.close()
-
-            # recalculate the function
-            print "no cache, recalculating %s" % filename
-            start = time.time()
-            retval = func(*args, **kwargs)
-
-            outfile = shelve.open(filename, "n", protocol=-1)
-            outfile["signature"] = identifier
-            outfile["filename"] = filename
-            outfile["funcname"] = funcname
-            outfile["args"] = rehashed
-            outfile["kwargs"] = kwargs
-            outfile["result"] = retval
-            outfile.close()
-            time.sleep(0.2)
-
-            # indicate that the function is done being recalculated
-            donefile = open(done_filename, "w")
-            donefile.write("%10.15f\n" % (time.time() - start))
-            donefile.close()
-
-            # remove the busy flag
-            os.remove(busy_filename)
+                return retval
+            except KeyError:
+                pass
+
+        # otherwise wait for any other calculation of it to finish (only a
+        # miss creates the lock's shard directory)
+        busy_filename = result_store.lock_filename(identifier)
+        busyfile = _lock_exclusive(busy_filename)
+        try:
+            if result_store.contains(identifier):
+                try:
+                    retval = result_store.load(identifier)
+                    print "used value cached while waiting %s" % filename
+                    return retval
+                except KeyError:
+                    pass
+
+            _claim(busyfile)
+            heartbeat = _Heartbeat(busy_filename, heartbeat_interval)
+            heartbeat.start()
+
+            try:
+                # recalculate the function
+                print "no cache, recalculating %s" % filename
+                start = time.time()
+                retval = func(*args, **kwargs)
+
+                record = {"signature": identifier,
+                          "funcname": funcname,
+                          "args": args,
+                          "kwargs": kwargs,
+                          "result": retval}
+
+                result_store.save(identifier, record, time.time() - start)
+            finally:
+                heartbeat.stop()
+        finally:
+            _unlock(busyfile, busy_filename)
 
         return retval
 
+    def cache_info():
+        with l1_lock:
+            if l1_cache is None:
+                return None
+
+            return l1_cache.info()
+
+    def cache_clear():
+        with l1_lock:
+            if l1_cache is not None:
+                l1_cache.clear()
+
+    memoize.cache_info = cache_info
+    memoize.cache_clear = cache_clear
+
     return functools.update_wrapper(memoize, func)
 
 
-@memoize_persistent
+@memoize_persistent(l1_maxsize=128)
 def fibonacci(n):
     """Example: return the nth fibonacci number."""
     if n in (0, 1):
@@ -135,7 +398,8 @@ def useless_loop(input_var, arg1='a', arg2=2):
 
 
 def _make_serializable_exaple(item):
-    r"""Serialize an ndarray extended by and .info field"""
+    r"""Serialize an ndarray extended by and .info field; for use with
+    fingerprint.register_hasher"""
     try:
         infofield = tuple(sorted(item.info.items()))
         fullarray = (item.tolist(), infofield)
@@ -154,11 +418,8 @@ def _repackage_kiyo(kiyo_map_split):
 
 
 if __name__ == "__main__":
-    print fibonacci(5)
-    print fibonacci(5)
-    print useless_loop(10, arg1=3, arg2='b')
-    print useless_loop(10, arg2='b', arg1=4)
-    print useless_loop("w", arg2="ok")
-    print useless_loop(10)
-    print useless_loop("w")
+    import doctest
 
+    OPTIONFLAGS = (doctest.ELLIPSIS |
+                   doctest.NORMALIZE_WHITESPACE)
+    doctest.testmod(optionflags=OPTIONFLAGS)
@@ -3,53 +3,166 @@ The job file is a shelve that contains
 "funcname" function name (including module etc.)
 "args" arguments for the function
 "kwargs" keyword arguments for the function
+"priority" jobs with a higher priority are claimed first (optional)
+"submitter" who submitted the job, for fair share (optional)
+"submitted" time.time() when the job was submitted (optional)
 
 the function is run; with outputs:
 "retval" returned data of the function
 "runlog" captured stdout of the function
+"accounting" queue wait, wall and CPU time, peak memory and worker PID of
+the job (see job_accounting; also appended to the host's accounting log,
+which scripts/summarize_jobs.py summarizes)
 
 to extend this for e.g. PBS, have the running process check for its cpu ID
+
+New jobs are found in three ways: submitters on the same host send the job
+name to the daemon's UNIX datagram socket (see notify_job), on Linux the job
+directory is watched with inotify, and the directory is also rescanned
+every `rescan_interval` seconds for jobs written from other hosts. Without
+inotify it is rescanned every `poll_interval` seconds.
+
+Several daemons (e.g. on different nodes) can share one job directory. A
+daemon claims a job by renaming "<identifier>.job" to
+"<identifier>.<daemon_id>.queue"; the rename is atomic, so exactly one
+daemon gets each job. A daemon claims at most `prefetch` jobs more than its
+workers are running (0: only when a worker is free), leaving the rest to
+the others, and an idle daemon
+steals jobs that another daemon claimed more than `steal_after` seconds ago
+but has not started (also those of a daemon that died). A worker starts a
+job by renaming it to "<identifier>.run", which fails if it was stolen.
+
+A daemon claims the waiting job with the highest priority first. Among
+those, it takes a job from the submitter it has served least recently
+(see FairShare), so a short interactive session is not stuck behind
+another user's batch. The queue depth and the wait until a job is claimed
+are printed for each priority every `stats_interval` seconds and at
+shutdown.
 """
-from multiprocessing import Process, Queue
+from multiprocessing import Process, Queue, Value
 import time
+import heapq
 import os
+import errno
 import glob
+import select
+import socket
 import sys
 import StringIO as StringIO
 import utils
 import shelve
+import dir_watch
+import job_accounting
 job_directory = "./jobs/"
+# UNIX socket for job notifications; by default "daemon.<host>.sock" in the
+# job directory, so that daemons on other nodes sharing it have their own
+socket_filename = None
+# seconds between directory scans with and without inotify
+rescan_interval = 5.
+poll_interval = 0.1
+# jobs a daemon claims beyond those its workers are running
+prefetch = 1
+# seconds after which a claimed job that was not started can be stolen
+steal_after = 30.
+# priority of jobs that do not give one
+default_priority = 0
+# seconds after which the jobs started for a submitter count half
+fairshare_halflife = 600.
+# seconds between printing the queue statistics
+stats_interval = 60.
+
+
+def daemon_id():
+    r"""name of this daemon in the names of the jobs it claims"""
+    return "%s-%d" % (socket.gethostname().replace(".", "_"), os.getpid())
+
+
+def job_identifier(job_filename):
+    r"""identifier of a job from any of its file names
+
+    >>> job_identifier("./jobs/2cb1.job")
+    '2cb1'
+    >>> job_identifier("/data/jobs/2cb1.node07-1234.queue")
+    '2cb1'
+    """
+    return os.path.basename(job_filename).split(".", 1)[0]
+
+
+def _claim(job_filename, owner):
+    r"""atomically rename a job (".job" or another daemon's ".queue") to a
+    ".queue" file of `owner`; None if another daemon got it first
+    """
+    queue_filename = os.path.join(os.path.dirname(job_filename), "%s.%s.queue"
+                                  % (job_identifier(job_filename), owner))
+    try:
+        os.rename(job_filename, queue_filename)
+    except OSError, error:
+        if error.errno == errno.ENOENT:
+            return None
+
+        raise
+
+    return queue_filename
 
 
 def process_job(job_filename):
-    basename = os.path.splitext(job_filename)[0]
+    r"""run a claimed job; returns False if another daemon stole it"""
+    basename = os.path.join(os.path.dirname(job_filename),
+                            job_identifier(job_filename))
 
     log_filename = "%s.log" % basename
     run_filename = "%s.run" % basename
     done_filename = "%s.done" % basename
 
-    os.rename(job_filename, run_filename)
+    try:
+        os.rename(job_filename, run_filename)
+    except OSError, error:
+        if error.errno == errno.ENOENT:
+            print "job was taken by another daemon"
+            return False
+
+        raise
+
     jobspec = shelve.open(run_filename, protocol=-1)
     print jobspec
     funcname = jobspec['funcname']
     args = jobspec['args']
     kwargs = jobspec['kwargs']
+    # the submit time of jobs from older submitters is when they were written
+    submitted = jobspec.get('submitted', os.path.getmtime(run_filename))
 
+    meter = job_accounting.JobMeter(submitted)
     retval = utils.func_exec(funcname, args, kwargs)
+    accounting = meter.stop()
     jobspec['retval'] = retval
+    jobspec['accounting'] = accounting
+    log_entry = dict(accounting, funcname=funcname,
+                     identifier=job_identifier(job_filename),
+                     priority=jobspec.get('priority', default_priority),
+                     submitter=jobspec.get('submitter', "unknown"))
     jobspec.close()
 
+    job_accounting.log_record(os.path.dirname(job_filename) or ".",
+                              log_entry)
+
     outlog = open(log_filename, "w")
     outlog.write(sys.stdout.getvalue())
     outlog.close()
 
     os.rename(run_filename, done_filename)
+    return True
 
 
 class Worker(Process):
-    def __init__(self, queue):
+    r"""Run jobs from `queue`; `outstanding` counts the claimed jobs that
+    have not finished, and the daemon is told on `socket_path` when a
+    worker finishes one so that it can claim more
+    """
+    def __init__(self, queue, outstanding=None, socket_path=None):
         super(Worker, self).__init__()
         self.queue = queue
+        self.outstanding = outstanding
+        self.socket_path = socket_path
 
     def run(self):
         #rename job file .running
@@ -75,43 +188,481 @@ class Worker(Process):
             sys.stdout = sys.__stdout__
             print utils.timestamp(), "Finished: ", job_filename
 
+            if self.outstanding is not None:
+                with self.outstanding.get_lock():
+                    self.outstanding.value -= 1
+
+                # without a socket of its own, the daemon polls instead
+                if self.socket_path is not None:
+                    _send("free", self.socket_path)
+
+
+def _socket_path(socket_path=None):
+    r"""the notification socket of the daemon on this host"""
+    return socket_path or socket_filename or \
+           os.path.join(job_directory, "daemon.%s.sock" %
+                        socket.gethostname().replace(".", "_"))
+
+
+def _remove_socket(socket_path, inode):
+    r"""remove the socket this daemon bound, unless it is already gone or
+    was replaced by another daemon's
+    """
+    try:
+        if os.stat(socket_path).st_ino == inode:
+            os.remove(socket_path)
+    except OSError:
+        pass
+
+
+def _send(message, socket_path=None):
+    r"""send a datagram to the daemon; False if no daemon is listening"""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+        sock.sendto(message, _socket_path(socket_path))
+    except socket.error:
+        return False
+    finally:
+        sock.close()
+
+    return True
+
+
+def notify_job(job_filename, socket_path=None):
+    r"""tell a daemon on this host that `job_filename` is ready; returns
+    False if none is listening (it will find the job when it rescans)
+    """
+    return _send("job %s" % os.path.basename(job_filename), socket_path)
+
+
+def request_shutdown(socket_path=None):
+    r"""ask a daemon on this host to stop, as the killfile does"""
+    return _send("kill", socket_path)
+
+
+def _listen(socket_path):
+    r"""bind the notification socket, or return None if another daemon
+    has it or it cannot be bound (e.g. on some network filesystems)
+    """
+    if os.path.exists(socket_path):
+        if _send("ping", socket_path):
+            print "another daemon is listening on %s" % socket_path
+            return None
+
+        # left over from a daemon on this host that did not shut down
+        try:
+            os.remove(socket_path)
+        except OSError:
+            pass
+
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+        listener.bind(socket_path)
+    except socket.error, error:
+        print "could not bind %s: %s" % (socket_path, error)
+        listener.close()
+        return None
+
+    listener.setblocking(False)
+    return listener
+
+
+def _receive(listener):
+    r"""all messages waiting on the notification socket"""
+    messages = []
+    while True:
+        try:
+            messages.append(listener.recv(4096))
+        except socket.error, error:
+            if error.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return messages
+
+            raise
+
+
+def _enqueue(job_filename, request_queue, owner, outstanding):
+    r"""claim a job file and hand it to the workers; False if another daemon
+    got it first
+    """
+    queue_filename = _claim(job_filename, owner)
+    if queue_filename is None:
+        return False
+
+    with outstanding.get_lock():
+        outstanding.value += 1
+
+    print "adding %s to queue" % queue_filename
+    request_queue.put(queue_filename)
+    return True
+
+
+def _steal(request_queue, owner, outstanding):
+    r"""claim one job that another daemon claimed over `steal_after`
+    seconds ago without starting it; True if one was stolen
+    """
+    now = time.time()
+    for queue_filename in glob.glob('%s/*.queue' % job_directory):
+        if queue_filename.endswith(".%s.queue" % owner):
+            continue
+
+        try:
+            # the rename that claimed it set the ctime
+            claimed_at = os.stat(queue_filename).st_ctime
+        except OSError:
+            continue
+
+        if now - claimed_at < steal_after:
+            continue
+
+        stolen_filename = _claim(queue_filename, owner)
+        if stolen_filename is not None:
+            with outstanding.get_lock():
+                outstanding.value += 1
+
+            print "stole %s" % queue_filename
+            request_queue.put(stolen_filename)
+            return True
+
+    return False
+
+
+def job_metadata(job_filename):
+    r"""(priority, submitter, submit time) from a job shelve, or None if it
+    cannot be read (e.g. while it is still being written)
+    """
+    try:
+        jobspec = shelve.open(job_filename, "r", protocol=-1)
+        try:
+            return (jobspec.get("priority", default_priority),
+                    jobspec.get("submitter", "unknown"),
+                    jobspec.get("submitted",
+                                os.path.getmtime(job_filename)))
+        finally:
+            jobspec.close()
+    except Exception:
+        return None
+
+
+class FairShare(object):
+    r"""Jobs waiting to be claimed, handed out with the highest priority
+    first; among those, the job of the submitter that was charged least
+    recently (charges count half after `fairshare_halflife` seconds) goes
+    first, and each submitter's jobs go in the order they were submitted.
+
+    >>> sched = FairShare()
+    >>> sched.add("a1.job", (0, "ann", 1.))
+    >>> sched.add("a2.job", (0, "ann", 2.))
+    >>> sched.add("a3.job", (0, "ann", 3.))
+    >>> sched.add("b1.job", (0, "bob", 4.))
+    >>> sched.add("c1.job", (10, "cy", 5.))
+    >>> sched.depths()
+    {0: 4, 10: 1}
+    >>> order = []
+    >>> while len(sched):
+    ...     (name, (priority, submitter, submitted)) = sched.pop(now=0.)
+    ...     sched.charge(submitter, now=0.)
+    ...     order.append(name)
+    >>> order
+    ['c1.job', 'a1.job', 'b1.job', 'a2.job', 'a3.job']
+    """
+    def __init__(self):
+        self.jobs = {}
+        # (priority, submitter) -> heap of (submit time, name)
+        self.queues = {}
+        # submitter -> (usage, time of the last charge)
+        self.usage = {}
+
+    def __len__(self):
+        return len(self.jobs)
+
+    def __contains__(self, name):
+        return name in self.jobs
+
+    def add(self, name, metadata):
+        (priority, submitter, submitted) = metadata
+        self.jobs[name] = metadata
+        heapq.heappush(self.queues.setdefault((priority, submitter), []),
+                       (submitted, name))
+
+    def retain(self, names):
+        r"""forget the jobs not in `names` (e.g. claimed by another daemon)
+        """
+        for name in set(self.jobs) - set(names):
+            del self.jobs[name]
+
+    def _usage(self, submitter, now):
+        (usage, charged) = self.usage.get(submitter, (0., now))
+        return usage * 0.5 ** ((now - charged) / fairshare_halflife)
+
+    def charge(self, submitter, now=None):
+        r"""count a job that was started for `submitter`"""
+        if now is None:
+            now = time.time()
+
+        self.usage[submitter] = (self._usage(submitter, now) + 1., now)
+
+    def pop(self, now=None):
+        r"""remove and return (name, metadata) of the next job"""
+        if now is None:
+            now = time.time()
+
+        while self.jobs:
+            top = max(priority for (priority, submitter) in self.queues)
+            submitters = [submitter for (priority, submitter) in self.queues
+                          if priority == top]
+            submitter = min(submitters,
+                            key=lambda item: (self._usage(item, now), item))
+            queue = self.queues[(top, submitter)]
+            (submitted, name) = heapq.heappop(queue)
+            if not queue:
+                del self.queues[(top, submitter)]
+
+            # skip the jobs that were forgotten or re-added since
+            metadata = self.jobs.get(name)
+            if metadata is not None and metadata[0] == top and \
+               metadata[1] == submitter and metadata[2] == submitted:
+                del self.jobs[name]
+                return (name, metadata)
+
+        raise KeyError("no jobs waiting")
+
+    def depths(self):
+        r"""number of jobs waiting in each priority"""
+        counts = {}
+        for (priority, submitter, submitted) in self.jobs.itervalues():
+            counts[priority] = counts.get(priority, 0) + 1
+
+        return counts
+
+
+class QueueStats(object):
+    r"""Queue depth (averaged over time) and wait from submission to claim
+    in each priority
+
+    >>> stats = QueueStats(start=0.)
+    >>> stats.sample({0: 4, 10: 1}, now=0.)
+    >>> stats.record_wait(10, 0.5)
+    >>> stats.sample({0: 4}, now=1.)
+    >>> stats.record_wait(0, 3.)
+    >>> stats.record_wait(0, 5.)
+    >>> stats.sample({0: 2}, now=2.)
+    >>> print stats.report(now=2.)
+    priority  waiting  mean depth  max depth  claimed  mean wait  max wait
+          10        0        0.50          1        1       0.50      0.50
+           0        2        4.00          4        2       4.00      5.00
+    """
+    def __init__(self, start=None):
+        if start is None:
+            start = time.time()
+
+        self.start = start
+        self.last_sample = start
+        self.current = {}
+        # priority -> [integral of depth over time, max depth]
+        self.depth = {}
+        # priority -> [claimed, total wait, max wait]
+        self.waits = {}
+
+    def sample(self, depths, now=None):
+        r"""the number of jobs waiting in each priority changed to `depths`
+        """
+        if now is None:
+            now = time.time()
+
+        elapsed = now - self.last_sample
+        for (priority, count) in self.current.iteritems():
+            self.depth[priority][0] += count * elapsed
+
+        for (priority, count) in depths.iteritems():
+            entry = self.depth.setdefault(priority, [0., 0])
+            entry[1] = max(entry[1], count)
+
+        self.current = dict(depths)
+        self.last_sample = now
+
+    def record_wait(self, priority, wait):
+        entry = self.waits.setdefault(priority, [0, 0., 0.])
+        entry[0] += 1
+        entry[1] += wait
+        entry[2] = max(entry[2], wait)
+
+    def report(self, now=None):
+        if now is None:
+            now = time.time()
+
+        self.sample(self.current, now)
+        duration = max(now - self.start, 1e-9)
+        lines = ["priority  waiting  mean depth  max depth  claimed  "
+                 "mean wait  max wait"]
+        for priority in sorted(set(self.depth) | set(self.waits),
+                               reverse=True):
+            (depth_time, max_depth) = self.depth.get(priority, (0., 0))
+            (claimed, total_wait, max_wait) = self.waits.get(priority,
+                                                             (0, 0., 0.))
+            lines.append("%8d  %7d  %10.2f  %9d  %7d  %9.2f  %8.2f" %
+                         (priority, self.current.get(priority, 0),
+                          depth_time / duration, max_depth, claimed,
+                          total_wait / max(claimed, 1), max_wait))
+
+        return "\n".join(lines)
+
 
 def start_workers(options):
+    r"""run `options['n_worker']` workers on the jobs in `job_directory`
+    until the killfile `options['killfile']` appears or a shutdown is
+    requested on the socket (`options['socket']`, see _socket_path);
+    `options['inotify']` set to False disables inotify and
+    `options['prefetch']` overrides `prefetch`.
+
+    The killfile stops every daemon on the job directory, so it is left in
+    place for the others to see; a daemon removes it when it starts.
+    """
     kill_watchfile = "%s/%s" % (job_directory, options['killfile'])
+    try:
+        # left by the last shutdown
+        os.remove(kill_watchfile)
+    except OSError, error:
+        if error.errno != errno.ENOENT:
+            raise
+
     n_worker = int(options['n_worker'])
+    n_prefetch = options.get('prefetch')
+    if n_prefetch is None:
+        n_prefetch = prefetch
+
+    if n_prefetch < 0:
+        raise ValueError("prefetch must be 0 or more, not %r" % n_prefetch)
+
+    # claimed jobs that have not finished: one per worker, plus prefetch
+    max_outstanding = n_worker + int(n_prefetch)
+    owner = daemon_id()
+
+    socket_path = _socket_path(options.get('socket'))
+    listener = _listen(socket_path)
+    if listener is not None:
+        socket_inode = os.stat(socket_path).st_ino
 
     request_queue = Queue()
+    outstanding = Value("i", 0)
     for i in range(n_worker):
-        Worker(request_queue).start()
+        Worker(request_queue, outstanding,
+               socket_path if listener is not None else None).start()
 
-    print "started %d workers" % n_worker
+    print "started %d workers as %s" % (n_worker, owner)
 
-    # check if there are files running; if kill, then drop runner
-    while True:
-        # if there is a shutdown trigger, apply
-        if os.path.isfile(kill_watchfile):
-            print "Got signal to kill job handler, exiting."
-            for i in range(n_worker):
-                request_queue.put(None)
+    watcher = None
+    if options.get('inotify', True):
+        watcher = dir_watch.watch(job_directory)
+
+    if watcher is not None:
+        interval = rescan_interval
+    else:
+        interval = poll_interval
+
+    print "watching %s (socket: %s, inotify: %s, rescan every %g s)" % \
+          (job_directory, listener is not None, watcher is not None,
+           interval)
+
+    # jobs that are ready but not claimed yet
+    scheduler = FairShare()
+    stats = QueueStats()
+    last_scan = 0.
+    last_report = time.time()
+    try:
+        while True:
+            shutdown = False
+            scanned = False
+            names = []
+
+            if time.time() - last_scan >= interval or \
+               (watcher is not None and watcher.overflowed):
+                last_scan = time.time()
+                if watcher is not None:
+                    watcher.overflowed = False
+
+                # if there is a shutdown trigger, apply
+                if os.path.isfile(kill_watchfile):
+                    shutdown = True
+                else:
+                    names = [os.path.basename(jfile) for jfile in
+                             glob.glob('%s/*.job' % job_directory)]
+                    scanned = True
+
+            has_room = outstanding.value < max_outstanding
+            if not shutdown and not scanned and \
+               not (has_room and len(scheduler)):
+                # don't press the filesystem looking for new jobs
+                waitables = [item for item in (listener, watcher)
+                             if item is not None]
+                timeout = max(interval - (time.time() - last_scan), 0.)
+                if len(scheduler) and listener is None:
+                    # no word from the workers when they take a job
+                    timeout = min(timeout, poll_interval)
+
+                if waitables:
+                    ready = select.select(waitables, [], [], timeout)[0]
+                else:
+                    time.sleep(timeout)
+                    ready = []
+
+                if watcher is not None and watcher in ready:
+                    names = watcher.read()
+
+                if listener is not None and listener in ready:
+                    for message in _receive(listener):
+                        if message == "kill":
+                            shutdown = True
+                        elif message.startswith("job "):
+                            names.append(message[4:])
+
+            if options['killfile'] in names and \
+               os.path.isfile(kill_watchfile):
+                shutdown = True
+
+            if shutdown:
+                print "Got signal to kill job handler, exiting."
+                print stats.report()
+                for i in range(n_worker):
+                    request_queue.put(None)
+
+                break
+
+            if scanned:
+                scheduler.retain(names)
 
-            os.remove(kill_watchfile)
-            break
+            for name in names:
+                # only the name is used, so only this directory is served;
+                # scatter renames finished jobs into place, but skip the
+                # temporary files of a database library writing one
+                name = os.path.basename(name)
+                if not name.endswith(".job") or "__db." in name or \
+                   name in scheduler:
+                    continue
 
-        # else, look for job files
-        job_files = glob.glob('%s/*.job' % job_directory)
-        if len(job_files) > 0:
-            print job_files
-            for jfile in job_files:
-                # do not start processing a file as scatter is writing the job
-                if "__db." not in jfile:
-                    basename = os.path.splitext(jfile)[0]
+                metadata = job_metadata(os.path.join(job_directory, name))
+                if metadata is not None:
+                    scheduler.add(name, metadata)
 
-                    queue_filename = "%s.queue" % basename
-                    os.rename(jfile, queue_filename)
+            while outstanding.value < max_outstanding and len(scheduler):
+                (name, (priority, submitter, submitted)) = scheduler.pop()
+                if _enqueue(os.path.join(job_directory, name),
+                            request_queue, owner, outstanding):
+                    scheduler.charge(submitter)
+                    stats.record_wait(priority, time.time() - submitted)
 
-                    print "adding %s to queue" % queue_filename
-                    request_queue.put(queue_filename)
+            if scanned and not len(scheduler):
+                while outstanding.value < max_outstanding and \
+                      _steal(request_queue, owner, outstanding):
+                    pass
 
-        # don't press the filesystem looking for new jobs
-        time.sleep(0.1)
+            stats.sample(scheduler.depths())
+            if time.time() - last_report >= stats_interval:
+                last_report = time.time()
+                print stats.report()
+    finally:
+        if listener is not None:
+            listener.close()
+            _remove_socket(socket_path, socket_inode)
 
+        if watcher is not None:
+            watcher.close()
@@ -0,0 +1,143 @@
+"""
+Runtimes of past calls, used to dispatch the longest calls first
+
+A RuntimeHistory keeps the mean elapsed time of each call, keyed by its
+funcname and argument fingerprint (fingerprint.call_identifier), in an
+SQLite database. MemoizeBatch and AggregateOutputs given a `history`
+record the runtime of every call they run and start a stack with the
+calls expected to take longest (longest-processing-time-first), so that
+long calls do not start last and leave the other workers idle at the end.
+
+Calls that were never timed are estimated by the mean runtime of their
+function, or by `default_runtime` for a function never seen.
+
+>>> import tempfile, shutil
+>>> tmpdir = tempfile.mkdtemp()
+>>> history = RuntimeHistory(tmpdir + "/runtimes.sqlite")
+>>> history.record("f", "key_a", 3.)
+>>> history.record("f", "key_b", 1.)
+>>> history.estimates("f", ["key_a", "key_b", "key_new"])
+[3.0, 1.0, 2.0]
+>>> lpt_order(["a", "b", "c"], [1., 5., 2.])
+[1, 2, 0]
+>>> expected_makespan([5., 2., 2., 1.], 2)
+5.0
+>>> shutil.rmtree(tmpdir)
+"""
+import heapq
+import os
+import time
+import cache_store
+
+# seconds assumed for a call to a function that was never timed
+default_runtime = 1.
+
+# default database, used when a class is given history=True
+history_filename = os.path.expanduser("~/.process_tools_runtimes.sqlite")
+
+
+class RuntimeHistory(cache_store.SQLiteDatabase):
+    r"""Mean runtimes of calls in the SQLite database `filename`
+
+    Worker processes can record into the same database; concurrent writers
+    wait up to `timeout` seconds for the write lock. The database is opened
+    in `journal_mode`, as for cache_store.SQLiteStore: WAL needs all
+    processes on one host, so use journal_mode="DELETE" for a database on a
+    network filesystem. The object can be pickled and sent to workers.
+    """
+    schema = ("CREATE TABLE IF NOT EXISTS runtimes ("
+              "funcname TEXT, "
+              "key TEXT, "
+              "elapsed REAL, "
+              "runs INTEGER, "
+              "updated REAL, "
+              "PRIMARY KEY (funcname, key))",)
+
+    def __init__(self, filename=None, timeout=60., journal_mode="WAL"):
+        super(RuntimeHistory, self).__init__(filename or history_filename,
+                                             timeout=timeout,
+                                             journal_mode=journal_mode)
+
+    def __repr__(self):
+        return "RuntimeHistory(%r)" % self.filename
+
+    def record(self, funcname, key, elapsed):
+        r"""add a runtime of the call `key` of `funcname` to its mean"""
+        connection = self._connection()
+        connection.execute("INSERT OR IGNORE INTO runtimes "
+                           "VALUES (?, ?, 0., 0, ?)",
+                           (funcname, key, time.time()))
+        connection.execute("UPDATE runtimes SET "
+                           "elapsed = (elapsed * runs + ?) / (runs + 1), "
+                           "runs = runs + 1, updated = ? "
+                           "WHERE funcname = ? AND key = ?",
+                           (elapsed, time.time(), funcname, key))
+
+    def estimates(self, funcname, keys):
+        r"""expected runtimes of the calls `keys` of `funcname`; calls
+        never timed get the mean of the function's runtimes, or
+        `default_runtime`
+        """
+        known = dict(self._connection().execute(
+                    "SELECT key, elapsed FROM runtimes WHERE funcname = ?",
+                    (funcname,)).fetchall())
+
+        if known:
+            fallback = sum(known.itervalues()) / len(known)
+        else:
+            fallback = default_runtime
+
+        return [known.get(key, fallback) for key in keys]
+
+    def num_known(self, funcname, keys):
+        r"""number of the calls `keys` that have a recorded runtime"""
+        known = set(row[0] for row in self._connection().execute(
+                    "SELECT key FROM runtimes WHERE funcname = ?",
+                    (funcname,)))
+
+        return sum(1 for key in keys if key in known)
+
+
+def lpt_order(items, estimates):
+    r"""indices of `items` ordered by decreasing estimated runtime; ties
+    keep their original order
+    """
+    return sorted(range(len(items)), key=lambda index: -estimates[index])
+
+
+def expected_makespan(estimates, num_workers):
+    r"""wall time to run calls taking `estimates` seconds in the given
+    order, each started on the first worker to become free
+    """
+    if not estimates:
+        return 0.
+
+    loads = [0.] * max(min(num_workers, len(estimates)), 1)
+    for estimate in estimates:
+        heapq.heapreplace(loads, loads[0] + estimate)
+
+    return max(loads)
+
+
+def order_stack(history, funcname, call_stack, keys, num_workers):
+    r"""return `call_stack` in longest-processing-time-first order and
+    print the expected makespan; `keys` are the history keys of the calls
+    """
+    estimates = history.estimates(funcname, keys)
+    order = lpt_order(call_stack, estimates)
+    estimates = [estimates[index] for index in order]
+
+    print "expected makespan: %.1f s on %d workers (%d of %d calls timed " \
+          "before, %.1f s of work)" % \
+          (expected_makespan(estimates, num_workers), num_workers,
+           history.num_known(funcname, keys), len(keys), sum(estimates))
+
+    return [call_stack[index] for index in order]
+
+
+if __name__ == "__main__":
+    import doctest
+
+    OPTIONFLAGS = (doctest.ELLIPSIS |
+                   doctest.NORMALIZE_WHITESPACE)
+    doctest.testmod(optionflags=OPTIONFLAGS)
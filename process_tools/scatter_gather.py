@@ -2,22 +2,34 @@ import multiprocessing
 import shelve
 import utils
 import time
-import hashlib
-import pickle
 import shelve
 import glob
 import os
+import getpass
 import h5py_tree as ht
 import process_daemon as pd
+import fingerprint
 """
 multiprocessing scatter gather functions
 
 make sure this will also work in single-threaded mode
+
+Jobs carry a `priority` (higher is claimed first by the daemon, e.g. for
+interactive work) and the `submitter` (by default the user name) that the
+daemon shares the workers between.
 """
 
-def _make_serializable(item):
-    """repackage an object so that it can be pickle.dumps()"""
-    return item
+def _rename_shelve(old_name, new_name):
+    r"""rename a closed shelve, also where the dbm module writes it as
+    several files (e.g. dumbdbm's ".dat" and ".dir")
+    """
+    if os.path.exists(old_name):
+        os.rename(old_name, new_name)
+        return
+
+    for suffix in (".dat", ".bak", ".db", ".dir"):
+        if os.path.exists(old_name + suffix):
+            os.rename(old_name + suffix, new_name + suffix)
 
 
 class ScatterGather(object):
@@ -31,23 +43,27 @@ class ScatterGather(object):
     >>> test_sg.scatter("a5", "a6", kwarg="no", execute_key="three")
     >>> test_sg.gather()
     """
-    def __init__(self, funcname, verbose=False):
+    def __init__(self, funcname, verbose=False, priority=None,
+                 submitter=None):
         self.call_stack = []
         self.funcname = funcname
         self.verbose = verbose
+        if priority is None:
+            priority = pd.default_priority
+
+        self.priority = priority
+        if submitter is None:
+            submitter = getpass.getuser()
+
+        self.submitter = submitter
 
     def scatter(self, *args, **kwargs):
         if "execute_key" not in kwargs:
             print "need to identify an execution key for the task"
             return
 
-        rehashed = [_make_serializable(item) for item in args]
-
-        argpkl = pickle.dumps((self.funcname, rehashed,
-                               tuple(sorted(kwargs.items()))), -1)
-
-        identifier = hashlib.sha224(argpkl).hexdigest()
-        readable = utils.readable_call(self.funcname, rehashed, kwargs)
+        identifier = fingerprint.call_identifier(self.funcname, args, kwargs)
+        readable = utils.readable_call(self.funcname, args, kwargs)
 
         # delete the kwarg for this function to associate an ID to the output
         # so it does not interfere with the function call.
@@ -65,16 +81,25 @@ class ScatterGather(object):
             if self.verbose:
                 print "all clear: ", donefile_name
 
-        job_shelve = shelve.open(jobfile_name, "n", protocol=-1)
+        # write the job under another name and rename it into place, so
+        # that a daemon never sees a partly written job
+        tmpfile_name = "%s/%s.submit" % (pd.job_directory, identifier)
+        job_shelve = shelve.open(tmpfile_name, "n", protocol=-1)
         job_shelve['funcname'] = self.funcname
         job_shelve['args'] = args
         job_shelve['kwargs'] = kwargs
         job_shelve['tag'] = execute_key
         job_shelve['identifier'] = identifier
         job_shelve['call'] = readable
+        job_shelve['priority'] = self.priority
+        job_shelve['submitter'] = self.submitter
+        job_shelve['submitted'] = time.time()
 
         #print job_shelve
         job_shelve.close()
+        _rename_shelve(tmpfile_name, jobfile_name)
+        # a daemon on this host picks the job up at once
+        pd.notify_job(jobfile_name)
 
         self.call_stack.append(identifier)
 
@@ -0,0 +1,203 @@
+"""
+Hand large ndarray arguments to pool workers through shared memory
+
+Pickling a call for a multiprocessing pool copies its array arguments into
+the pipe, once per call. share() instead writes each large array once to a
+".npy" file under `shm_directory` (a RAM-backed tmpfs on Linux) and puts a
+small SharedArray handle in its place; restore() in the worker replaces the
+handles by read-only memory maps of those files, so all workers read the
+same pages. Arrays with the same contents are written once by an exporter
+(they are found by fingerprint.digest).
+
+AggregateOutputs and MemoizeBatch do this with `share_arrays=True`.
+
+>>> exporter = ArrayExporter(min_bytes=0)
+>>> args = exporter.share((np.arange(4.), "label"))
+>>> args
+(SharedArray('...npy', '<f8', (4,)), 'label')
+>>> view = restore(args)[0]
+>>> view.tolist(), view.flags.writeable
+([0.0, 1.0, 2.0, 3.0], False)
+>>> exporter.release()
+"""
+import atexit
+import binascii
+import os
+import tempfile
+import threading
+import fingerprint
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+if os.path.isdir("/dev/shm"):
+    shm_directory = "/dev/shm"
+else:
+    shm_directory = tempfile.gettempdir()
+
+# files written by this process, removed at exit
+_exported = set()
+_exported_lock = threading.Lock()
+
+
+class SharedArray(object):
+    r"""Picklable handle to an array written by ArrayExporter"""
+    def __init__(self, filename, dtype, shape):
+        self.filename = filename
+        self.dtype = dtype
+        self.shape = shape
+
+    def __repr__(self):
+        return "SharedArray(%r, %r, %r)" % (self.filename, self.dtype,
+                                            self.shape)
+
+    def open(self):
+        r"""read-only memmap of the array"""
+        return np.load(self.filename, mmap_mode="r")
+
+
+def _walk(tree, leaf):
+    r"""rebuild tuples, lists and dicts with leaf() applied to the others;
+    subclasses such as namedtuples and OrderedDicts are leaves, so they are
+    passed on unchanged (as in cache_store._split_arrays)
+    """
+    if type(tree) is tuple:
+        return tuple(_walk(value, leaf) for value in tree)
+
+    if type(tree) is list:
+        return [_walk(value, leaf) for value in tree]
+
+    if type(tree) is dict:
+        return dict((key, _walk(value, leaf))
+                    for (key, value) in tree.iteritems())
+
+    return leaf(tree)
+
+
+def restore(tree):
+    r"""replace the SharedArray handles in nested tuples, lists and dicts by
+    read-only views of the shared arrays
+
+    >>> import collections
+    >>> Point = collections.namedtuple("Point", "x y")
+    >>> restore((Point(1, 2), collections.OrderedDict([("b", 1)])))
+    (Point(x=1, y=2), OrderedDict([('b', 1)]))
+
+    Each file is mapped once per call rather than once per process, so the
+    mapping goes with the arguments and a released file does not stay
+    pinned in memory by a long-lived worker.
+    """
+    views = {}
+
+    def open_view(item):
+        if not isinstance(item, SharedArray):
+            return item
+
+        view = views.get(item.filename)
+        if view is None:
+            view = item.open()
+            views[item.filename] = view
+
+        return view
+
+    return _walk(tree, open_view)
+
+
+class ArrayExporter(object):
+    r"""Write ndarray arguments to shared memory files, once per array
+
+    `min_bytes` is the size below which arrays are left to be pickled
+    `directory` is where the files go (default: `shm_directory`)
+    """
+    def __init__(self, min_bytes=1 << 20, directory=None):
+        self.min_bytes = min_bytes
+        self.directory = directory or shm_directory
+        # in the file names, so that exporters sharing equal arrays do not
+        # remove each other's files
+        self.token = binascii.hexlify(os.urandom(4))
+        # id of the array: (array, handle); keeps the arrays alive so that
+        # the ids stay valid
+        self._by_id = {}
+        # digest of the contents: handle
+        self._by_digest = {}
+
+    def share(self, tree):
+        r"""return `tree` with its large ndarrays replaced by handles"""
+        return _walk(tree, self._share_leaf)
+
+    def _share_leaf(self, item):
+        if np is None or not isinstance(item, np.ndarray) or item.dtype.hasobject or \
+           item.nbytes < self.min_bytes:
+            return item
+
+        try:
+            return self._by_id[id(item)][1]
+        except KeyError:
+            pass
+
+        item_digest = fingerprint.digest(item)
+        handle = self._by_digest.get(item_digest)
+        if handle is None:
+            handle = self._write(item, item_digest)
+            self._by_digest[item_digest] = handle
+
+        self._by_id[id(item)] = (item, handle)
+        return handle
+
+    def _write(self, item, item_digest):
+        filename = os.path.join(self.directory, "process_tools_%d_%s_%s.npy" %
+                                (os.getpid(), self.token, item_digest))
+        (fd, tmp_filename) = tempfile.mkstemp(dir=self.directory,
+                                              suffix=".npy.tmp")
+        try:
+            with os.fdopen(fd, "wb") as tmp_file:
+                np.save(tmp_file, item)
+
+            os.rename(tmp_filename, filename)
+        except BaseException:
+            os.remove(tmp_filename)
+            raise
+
+        with _exported_lock:
+            _exported.add(filename)
+
+        return SharedArray(filename, item.dtype.str, item.shape)
+
+    def release(self):
+        r"""remove the shared files; handles given out before no longer
+        work
+        """
+        for handle in self._by_digest.itervalues():
+            _remove(handle.filename)
+
+        self._by_id.clear()
+        self._by_digest.clear()
+
+    def __len__(self):
+        return len(self._by_digest)
+
+
+def _remove(filename):
+    with _exported_lock:
+        _exported.discard(filename)
+
+    try:
+        os.remove(filename)
+    except OSError:
+        pass
+
+
+@atexit.register
+def _remove_exported():
+    for filename in list(_exported):
+        _remove(filename)
+
+
+if __name__ == "__main__":
+    import doctest
+
+    OPTIONFLAGS = (doctest.ELLIPSIS |
+                   doctest.NORMALIZE_WHITESPACE)
+    doctest.testmod(optionflags=OPTIONFLAGS)
@@ -1,6 +1,8 @@
 import time
 import string
 import os
+import sys
+import importlib
 import logging as log
 import datetime
 
@@ -168,9 +170,93 @@ def _test_func(arg1, kwarg1="test"):
     print arg1, kwarg1
 
 
+# dotted name: resolved function (or other attribute)
+_resolved = {}
+
+
+def resolve(funcname):
+    r"""Return the object named by `funcname`, which is either a name in this
+    module or a dotted path [package].[module].[attribute...], e.g.
+    "module.Class.method". Results are cached, so the import and attribute
+    lookups are only done once per name. Raises ImportError with the part of
+    the name that could not be found.
+
+    >>> resolve("os.path.join") is os.path.join
+    True
+    >>> resolve("os.path.no_such_function")
+    Traceback (most recent call last):
+    ...
+    ImportError: cannot resolve 'os.path.no_such_function': 'os.path' has no attribute 'no_such_function'
+    """
+    try:
+        return _resolved[funcname]
+    except KeyError:
+        pass
+
+    funcsplit = funcname.split(".")
+    if len(funcsplit) == 1 and funcname in globals():
+        target = globals()[funcname]
+    else:
+        target = _resolve_dotted(funcname, funcsplit)
+
+    _resolved[funcname] = target
+    return target
+
+
+def _resolve_dotted(funcname, funcsplit):
+    r"""import the longest importable module prefix of `funcsplit` and look
+    up the rest of the name as attributes
+    """
+    import_error = None
+    for index in range(len(funcsplit), 0, -1):
+        modname = ".".join(funcsplit[0:index])
+        try:
+            target = importlib.import_module(modname)
+        except ImportError, exception:
+            # on success this is the error from one level deeper
+            import_error = exception
+            continue
+
+        for attr_index in range(index, len(funcsplit)):
+            try:
+                target = getattr(target, funcsplit[attr_index])
+            except AttributeError:
+                owner = ".".join(funcsplit[0:attr_index])
+                message = "cannot resolve %r: %r has no attribute %r" % \
+                          (funcname, owner, funcsplit[attr_index])
+                if attr_index == index and index < len(funcsplit) - 1:
+                    message += " (importing %s: %s)" % \
+                               (".".join(funcsplit[0:index + 1]),
+                                import_error)
+
+                raise ImportError(message)
+
+        return target
+
+    raise ImportError("cannot resolve %r: %s" % (funcname, import_error))
+
+
+def preload(funcnames):
+    r"""Resolve a list of function names ahead of time, e.g. when a worker
+    process starts, so that later calls do not pay for the imports. Names
+    that cannot be resolved are returned with their errors.
+
+    >>> preload(["os.path.join", "no_such_module.func"])
+    {'no_such_module.func': "cannot resolve 'no_such_module.func': No module named no_such_module"}
+    """
+    failed = {}
+    for funcname in funcnames:
+        try:
+            resolve(funcname)
+        except ImportError, exception:
+            failed[funcname] = str(exception)
+
+    return failed
+
+
 def func_exec(funcname, args, kwargs, printcall=True):
     """Execute a function based on its module.name with a given set of
-    arguments and kwargs.
+    arguments and kwargs; the function is found by resolve().
 
     >>> func_exec("_test_func", ["this works"], {"kwarg1": "ok"})
     _test_func('this works', kwarg1='ok')
@@ -179,20 +265,7 @@ def func_exec(funcname, args, kwargs, printcall=True):
     if printcall:
         print readable_call(funcname, args, kwargs)
 
-    funcattr = None
-    funcsplit = funcname.split(".")
-
-    # consider http://docs.python.org/dev/library/importlib.html
-    if len(funcsplit) > 1:
-        mod = __import__(".".join(funcsplit[0:-1]))
-        for comp in funcsplit[1:-1]:
-            mod = getattr(mod, comp)
-
-        funcattr = getattr(mod, funcsplit[-1])
-    else:
-        funcattr = globals()[funcsplit[0]]
-
-    return funcattr(*args, **kwargs)
+    return resolve(funcname)(*args, **kwargs)
 
 
 if __name__ == "__main__":
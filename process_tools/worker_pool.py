@@ -0,0 +1,226 @@
+"""
+Long-lived multiprocessing pools shared between call stacks
+
+Creating a multiprocessing.Pool for every batch means paying for process
+start-up and for importing numpy, h5py and the user modules again each
+time. A WorkerPool starts its processes on first use and keeps them until
+shutdown() or the end of the program, so it can be handed to several
+multiprocess_stack calls (the `pool` argument of MemoizeBatch and
+AggregateOutputs).
+
+`preload` lists modules or dotted function names that each worker imports
+and resolves (see utils.preload) when it starts; `maxtasksperchild`
+replaces a worker after that many tasks, e.g. to bound leaked memory.
+
+imap_stack() runs a call stack in a given pool or in one started for it,
+longest calls first when there is a runtime history; MemoizeBatch and
+AggregateOutputs dispatch their stacks through it.
+
+>>> pool = WorkerPool(processes=2, preload=["aggregate_outputs"])
+>>> sorted(pool.imap_unordered(abs, [-1, -2, 3]))
+[1, 2, 3]
+>>> pool.shutdown()
+"""
+import atexit
+import multiprocessing
+import multiprocessing.pool
+import threading
+import weakref
+import utils
+import runtime_history
+
+# pools that are shut down when the program exits
+_live_pools = weakref.WeakSet()
+_shared_pools = {}
+_shared_lock = threading.Lock()
+
+
+def _worker_init(preload, initializer, initargs):
+    r"""run at the start of each worker process"""
+    failed = utils.preload(preload)
+    for funcname in sorted(failed):
+        multiprocessing.get_logger().warning(
+                    "worker_pool: could not preload %s" % failed[funcname])
+
+    if initializer is not None:
+        initializer(*initargs)
+
+
+class WorkerPool(object):
+    r"""A multiprocessing.Pool that is started on first use and reused
+
+    `processes` is the number of workers (default: the number of CPUs)
+    `preload` is a list of module or dotted function names to resolve in
+    each worker as it starts
+    `initializer(*initargs)` is then called in each worker
+    `maxtasksperchild` is the number of tasks after which a worker is
+    replaced (default: never)
+    """
+    def __init__(self, processes=None, preload=(), initializer=None,
+                 initargs=(), maxtasksperchild=None):
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+
+        self.processes = max(processes, 1)
+        self.preload = tuple(preload)
+        self.initializer = initializer
+        self.initargs = tuple(initargs)
+        self.maxtasksperchild = maxtasksperchild
+        self._pool = None
+        self._lock = threading.Lock()
+        _live_pools.add(self)
+
+    def __repr__(self):
+        return "WorkerPool(processes=%d, preload=%r, maxtasksperchild=%r)" % \
+               (self.processes, self.preload, self.maxtasksperchild)
+
+    @property
+    def pool(self):
+        r"""the underlying multiprocessing.Pool, started if needed"""
+        with self._lock:
+            if self._pool is None:
+                self._pool = multiprocessing.Pool(
+                            processes=self.processes,
+                            initializer=_worker_init,
+                            initargs=(self.preload, self.initializer,
+                                      self.initargs),
+                            maxtasksperchild=self.maxtasksperchild)
+
+            return self._pool
+
+    def map(self, func, iterable, chunksize=None):
+        return self.pool.map(func, iterable, chunksize)
+
+    def imap_unordered(self, func, iterable, chunksize=1):
+        return self.pool.imap_unordered(func, iterable, chunksize)
+
+    def apply_async(self, func, args=(), kwds={}):
+        return self.pool.apply_async(func, args, kwds)
+
+    def shutdown(self, wait=True):
+        r"""stop the workers; with `wait`, let them finish queued tasks
+        first. The pool starts again if it is used afterwards.
+        """
+        with self._lock:
+            pool = self._pool
+            self._pool = None
+
+        if pool is None:
+            return
+
+        if wait:
+            pool.close()
+        else:
+            pool.terminate()
+
+        pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.shutdown(wait=exc_type is None)
+
+
+def shared_pool(processes=None, preload=(), maxtasksperchild=None):
+    r"""Return the WorkerPool shared by all callers asking for the same
+    configuration, creating it on first use
+
+    >>> shared_pool(processes=2) is shared_pool(processes=2)
+    True
+    """
+    key = (processes, tuple(sorted(preload)), maxtasksperchild)
+    with _shared_lock:
+        pool = _shared_pools.get(key)
+        if pool is None:
+            pool = WorkerPool(processes=processes, preload=preload,
+                              maxtasksperchild=maxtasksperchild)
+            _shared_pools[key] = pool
+
+    return pool
+
+
+def imap_stack(func, call_stack, processes, chunksize=1, pool=None,
+               backend="process", history=None, funcname=None, key=None):
+    r"""Yield func(item) for each item of `call_stack` as the calls complete
+
+    `backend` "serial" makes the calls in this process, "thread" in a
+    ThreadPool and "process" in a multiprocessing.Pool of `processes`
+    workers, started for this stack and stopped when it finishes or is
+    abandoned. A `pool` (WorkerPool or multiprocessing.Pool) given instead
+    runs the calls and stays up for later stacks.
+
+    With a runtime_history.RuntimeHistory `history`, the calls expected to
+    take longest are started first (see runtime_history.order_stack); the
+    history key of an item is `key(item)`, among the runtimes of `funcname`.
+
+    >>> sorted(imap_stack(abs, [-1, -2, 3], 2))
+    [1, 2, 3]
+    >>> list(imap_stack(abs, [-1, -2, 3], 2, backend="serial"))
+    [1, 2, 3]
+    """
+    if not call_stack:
+        return
+
+    if history is not None:
+        if backend == "serial":
+            num_workers = 1
+        elif pool is not None:
+            num_workers = getattr(pool, "processes",
+                                  getattr(pool, "_processes", processes))
+        else:
+            num_workers = processes
+
+        call_stack = runtime_history.order_stack(
+                            history, funcname, call_stack,
+                            [key(item) for item in call_stack], num_workers)
+
+    if backend == "serial":
+        for item in call_stack:
+            yield func(item)
+
+        return
+
+    if pool is not None:
+        # a shared pool stays up for later stacks
+        for result in pool.imap_unordered(func, call_stack, chunksize):
+            yield result
+
+        return
+
+    if backend == "thread":
+        pool = multiprocessing.pool.ThreadPool(processes=processes)
+    else:
+        pool = multiprocessing.Pool(processes=processes)
+
+    try:
+        for result in pool.imap_unordered(func, call_stack, chunksize):
+            yield result
+
+        pool.close()
+    except BaseException:
+        # an exception or a consumer that stopped early
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+def shutdown_all(wait=True):
+    r"""shut down every WorkerPool; called when the program exits"""
+    for pool in list(_live_pools):
+        pool.shutdown(wait=wait)
+
+    with _shared_lock:
+        _shared_pools.clear()
+
+
+atexit.register(shutdown_all)
+
+
+if __name__ == "__main__":
+    import doctest
+
+    OPTIONFLAGS = (doctest.ELLIPSIS |
+                   doctest.NORMALIZE_WHITESPACE)
+    doctest.testmod(optionflags=OPTIONFLAGS)
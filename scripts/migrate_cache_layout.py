@@ -0,0 +1,24 @@
+#!/usr/bin/python
+from process_tools import cache_store
+from optparse import OptionParser
+
+
+if __name__ == '__main__':
+    r"""move a flat memoize cache directory into the sharded layout"""
+
+    parser = OptionParser(usage="usage: %prog [options] cache_directory",
+                          version="%prog 1.0")
+
+    parser.add_option("-v", "--verbose",
+                      action="store_true",
+                      dest="verbose",
+                      default=False,
+                      help="Print each record as it is moved",)
+
+    (options, args) = parser.parse_args()
+
+    if len(args) != 1:
+        parser.error("wrong number of arguments")
+
+    moved = cache_store.migrate_to_sharded(args[0], verbose=options.verbose)
+    print "moved %d records into the sharded layout" % moved
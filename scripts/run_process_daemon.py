@@ -15,7 +15,8 @@ if __name__ == '__main__':
                       action="store",
                       dest="killfile",
                       default="kill",
-                      help="If this file exists, shutdown",)
+                      help="If this file exists in the job directory, "
+                           "shutdown (all daemons sharing it)",)
 
     parser.add_option("-n", "--n_worker",
                       action="store",
@@ -23,6 +24,27 @@ if __name__ == '__main__':
                       default=5,
                       help="Number of workers to spawn",)
 
+    parser.add_option("-p", "--prefetch",
+                      action="store",
+                      type="int",
+                      dest="prefetch",
+                      default=None,
+                      help="Jobs to claim beyond those being run "
+                           "(default: process_daemon.prefetch)",)
+
+    parser.add_option("-s", "--socket",
+                      action="store",
+                      dest="socket",
+                      default=None,
+                      help="UNIX socket for job notifications "
+                           "(default: daemon.<host>.sock in the job directory)",)
+
+    parser.add_option("--no_inotify",
+                      action="store_false",
+                      dest="inotify",
+                      default=True,
+                      help="Poll the job directory instead of using inotify",)
+
     (options, args) = parser.parse_args()
     optdict = vars(options)
 
@@ -0,0 +1,32 @@
+#!/usr/bin/python
+from process_tools import job_accounting
+from process_tools import process_daemon as pd
+from optparse import OptionParser
+
+
+if __name__ == '__main__':
+    r"""summarize the resources used by the jobs run in a job directory"""
+
+    parser = OptionParser(usage="usage: %prog [options] [job_directory]",
+                          version="%prog 1.0")
+
+    parser.add_option("-n", "--n_worker",
+                      action="store",
+                      type="int",
+                      dest="n_worker",
+                      default=None,
+                      help="Workers that were available, to report the "
+                           "fraction kept busy",)
+
+    (options, args) = parser.parse_args()
+
+    if len(args) > 1:
+        parser.error("wrong number of arguments")
+
+    if args:
+        job_directory = args[0]
+    else:
+        job_directory = pd.job_directory
+
+    print job_accounting.summarize_directory(job_directory,
+                                             n_worker=options.n_worker)
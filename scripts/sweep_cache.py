@@ -0,0 +1,71 @@
+#!/usr/bin/python
+from process_tools import cache_store
+from process_tools import cache_manager
+from optparse import OptionParser
+import os
+
+UNITS = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+
+
+def parse_bytes(size):
+    r"""convert e.g. "500M" or "2G" to bytes"""
+    if size[-1].upper() in UNITS:
+        return int(float(size[:-1]) * UNITS[size[-1].upper()])
+
+    return int(size)
+
+
+if __name__ == '__main__':
+    r"""remove least recently used results from a memoize cache"""
+
+    parser = OptionParser(usage="usage: %prog [options] cache",
+                          version="%prog 1.0")
+
+    parser.add_option("-b", "--max_bytes",
+                      action="store",
+                      dest="max_bytes",
+                      default=None,
+                      help="Total size to keep, e.g. 500M or 2G",)
+
+    parser.add_option("-a", "--max_age_days",
+                      action="store",
+                      type="float",
+                      dest="max_age_days",
+                      default=None,
+                      help="Remove results not used for this many days",)
+
+    parser.add_option("-s", "--sharded",
+                      action="store_true",
+                      dest="sharded",
+                      default=False,
+                      help="The cache directory uses the sharded layout",)
+
+    parser.add_option("-v", "--verbose",
+                      action="store_true",
+                      dest="verbose",
+                      default=False,
+                      help="Print each record as it is removed",)
+
+    (options, args) = parser.parse_args()
+
+    if len(args) != 1:
+        parser.error("wrong number of arguments")
+
+    if os.path.isdir(args[0]):
+        store = cache_store.ShelveStore(args[0], sharded=options.sharded)
+    else:
+        store = cache_store.SQLiteStore(args[0])
+
+    max_bytes = None
+    if options.max_bytes:
+        max_bytes = parse_bytes(options.max_bytes)
+
+    max_age = None
+    if options.max_age_days is not None:
+        max_age = options.max_age_days * 86400.
+
+    (removed, freed) = cache_manager.sweep(store, max_bytes=max_bytes,
+                                           max_age=max_age,
+                                           verbose=options.verbose)
+
+    print "removed %d records, freed %d bytes" % (removed, freed)
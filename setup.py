@@ -9,6 +9,9 @@ setup(
     license='GPL',
     long_description=open('README.md').read(),
     scripts = [
-        'scripts/run_process_daemon.py'
+        'scripts/run_process_daemon.py',
+        'scripts/migrate_cache_layout.py',
+        'scripts/sweep_cache.py',
+        'scripts/summarize_jobs.py'
     ]
 )